@@ -0,0 +1,58 @@
+"""
+Compares the "soup" and "fast" menu parser engines on every layout in
+layouts/: checks that both return exactly the same schedule (including
+day order) and prints their timings and the speedup.
+
+    python benchmarks/bench_menu_parsers.py [--repeat N]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from menu_parser import MENU_PARSERS  # noqa: E402
+
+
+def best_time(func, html, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(html)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--repeat", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    soup_parse = MENU_PARSERS["soup"]
+    fast_parse = MENU_PARSERS["fast"]
+    ok = True
+
+    print(f"{'layout':<36}{'KB':>6}{'soup ms':>10}{'fast ms':>10}{'speedup':>9}")
+    for path in sorted(glob.glob(os.path.join(ROOT, "layouts", "*.html"))):
+        with open(path, "r", encoding="utf-8") as f:
+            html = f.read()
+
+        same = list(soup_parse(html).items()) == list(fast_parse(html).items())
+        ok = ok and same
+
+        soup_time = best_time(soup_parse, html, args.repeat)
+        fast_time = best_time(fast_parse, html, args.repeat)
+        print(f"{os.path.basename(path):<36}{len(html.encode('utf-8')) / 1024:>6.0f}"
+              f"{soup_time * 1000:>10.1f}{fast_time * 1000:>10.1f}{soup_time / fast_time:>8.1f}x"
+              f"{'' if same else '  MISMATCH'}")
+
+    if not ok:
+        print("fast parser output differs from parse_food_schedule")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
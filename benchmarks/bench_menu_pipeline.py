@@ -0,0 +1,271 @@
+"""
+Benchmarks every stage of the food-query hot path against the committed
+layouts/ fixtures: parse_food_schedule (soup and fast engines),
+clean_food_name, merge_weekly_menus, format_meals and a full
+process_food_query_internal call with a fake Update (cold and warm cache,
+and a burst of concurrent cold requests that share one menu load).
+
+For each stage it reports the median/min time per call (fast stages are
+looped so every sample lasts at least ~50 ms) and the memory allocated by
+one call (tracemalloc peak and total).
+
+Every sample is paired with a sample of a fixed reference workload, and a
+stage's "relative" time is the median of (stage / reference). That cancels
+out a machine that is slower as a whole during a run (CPU frequency,
+other processes). Results can be saved as a JSON baseline and later runs
+compared against it. A stage is a regression only if:
+- its relative median grew by more than --threshold, or by more than 3
+  standard errors of the two medians if that is larger (estimated from
+  the interquartile range of the samples, the "spread");
+- and its median grew by at least --min-delta ms, so the noise in stages
+  that take a few microseconds is ignored.
+
+    python benchmarks/bench_menu_pipeline.py --save benchmarks/baseline.json
+    python benchmarks/bench_menu_pipeline.py --compare benchmarks/baseline.json --threshold 0.25
+"""
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import bot  # noqa: E402
+from menu_parser import MENU_PARSERS, clean_food_name, merge_weekly_menus  # noqa: E402
+
+LAYOUTS = {
+    "kharazmi": "layouts/kharazmi_menu.html",
+    "tehran_lunch": "layouts/tehran_menu_lunch.html",
+    "tehran_dinner": "layouts/tehran_menu_dinner.html"
+}
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append(text)
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    def __init__(self, chat_id, text):
+        self.effective_chat = FakeChat(chat_id)
+        self.message = FakeMessage(text)
+
+
+MIN_SAMPLE_SECONDS = 0.05
+# a regression must exceed this many standard errors of the two medians
+SPREAD_FACTOR = 3
+
+
+def reference_workload():
+    """Fixed pure-Python work (strings, dicts, sorting, like the parsers) used as the unit of time."""
+    names = {}
+    for i in range(500):
+        key = f"food {i % 50}"
+        names[key] = names.get(key, "") + str(i)
+    return sorted(names.values(), key=len)
+
+
+def calls_per_sample(func):
+    """Like timeit's autorange: how many calls make one sample last MIN_SAMPLE_SECONDS."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - started >= MIN_SAMPLE_SECONDS:
+            return number
+        number *= 2
+
+
+def time_per_call(func, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - started) * 1000 / number
+
+
+def measure(func, repeat, reference_number):
+    """Returns per-call timing (ms) and allocation (KB) stats for func(); GC is off while timing, as in timeit."""
+    number = calls_per_sample(func)
+    func()  # warm up
+
+    timings = []
+    ratios = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            reference_ms = time_per_call(reference_workload, reference_number)
+            timings.append(time_per_call(func, number))
+            ratios.append(timings[-1] / reference_ms)
+    finally:
+        gc.enable()
+    relative = statistics.median(ratios)
+    quartiles = statistics.quantiles(ratios, n=4)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename") if stat.size_diff > 0)
+
+    return {
+        "calls_per_sample": number,
+        "median_ms": statistics.median(timings),
+        "min_ms": min(timings),
+        "relative": relative,
+        "spread": (quartiles[2] - quartiles[0]) / relative,
+        "peak_kb": peak / 1024,
+        "allocated_kb": allocated / 1024
+    }
+
+
+def build_stages():
+    html = {}
+    for name, path in LAYOUTS.items():
+        with open(path, "r", encoding="utf-8") as f:
+            html[name] = f.read()
+
+    soup_parse = MENU_PARSERS["soup"]
+    fast_parse = MENU_PARSERS["fast"]
+    lunch = soup_parse(html["tehran_lunch"])
+    dinner = soup_parse(html["tehran_dinner"])
+    kharazmi = soup_parse(html["kharazmi"])
+
+    raw_food_names = [
+        f"{food} 12,000 تومان"
+        for schedule in (kharazmi, lunch, dinner)
+        for meals in schedule.values()
+        for meal in ("صبحانه", "ناهار", "شام")
+        for food in meals[meal]
+    ]
+
+    loop = asyncio.new_event_loop()
+    bot.USER_DIRECTORY[1] = "خوارزمی"
+    bot.USER_DIRECTORY[2] = "تهران"
+
+    def query(chat_id, text, cold):
+        def run():
+            if cold:
+                bot.MENU_CACHE.clear()
+                bot.REPLY_CACHE.clear()
+            update = FakeUpdate(chat_id, text)
+            loop.run_until_complete(bot.process_food_query_internal(update, None))
+            assert update.message.replies, "process_food_query_internal sent no reply"
+        return run
+
+    def burst(chat_id, text, size):
+        def run():
+            bot.MENU_CACHE.clear()
+            bot.REPLY_CACHE.clear()
+            updates = [FakeUpdate(chat_id, text) for _ in range(size)]
+
+            async def send_all():
+                await asyncio.gather(*(bot.process_food_query_internal(update, None) for update in updates))
+
+            loop.run_until_complete(send_all())
+            assert all(update.message.replies for update in updates), "process_food_query_internal sent no reply"
+        return run
+
+    stages = {}
+    for name in LAYOUTS:
+        stages[f"parse_food_schedule[{name}]"] = lambda n=name: soup_parse(html[n])
+        stages[f"fast_parse_food_schedule[{name}]"] = lambda n=name: fast_parse(html[n])
+    stages[f"clean_food_name[x{len(raw_food_names)}]"] = lambda: [clean_food_name(f) for f in raw_food_names]
+    stages["merge_weekly_menus[tehran]"] = lambda: merge_weekly_menus(lunch, dinner)
+    stages["format_meals[kharazmi week]"] = lambda: [bot.format_meals(meals) for meals in kharazmi.values()]
+    for uni_name, chat_id in (("kharazmi", 1), ("tehran", 2)):
+        for query_name, text in (("today", "غذای امروز"), ("week", "غذای این هفته")):
+            stages[f"process_food_query_internal[{uni_name} {query_name}, cold]"] = query(chat_id, text, True)
+            stages[f"process_food_query_internal[{uni_name} {query_name}, warm]"] = query(chat_id, text, False)
+    stages["process_food_query_internal[kharazmi today, cold x20]"] = burst(1, "غذای امروز", 20)
+    return stages, loop
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    regressions = []
+    print(f"\n{'stage':<58}{'baseline':>10}{'now':>10}{'change':>9}{'allowed':>9}")
+    for name, stats in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if not base or "relative" not in base:
+            print(f"{name:<58}{'-':>10}{stats['median_ms']:>10.3f}{'new':>9}")
+            continue
+        change = stats["relative"] / base["relative"] - 1
+        noise = base["spread"] / math.sqrt(baseline["repeat"]) + stats["spread"] / math.sqrt(results["repeat"])
+        allowed = max(threshold, SPREAD_FACTOR * noise)
+        flag = ""
+        if change > allowed and stats["median_ms"] - base["median_ms"] >= min_delta_ms:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<58}{base['median_ms']:>10.3f}{stats['median_ms']:>10.3f}{change:>+8.0%}{allowed:>9.0%}{flag}")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--repeat", type=int, default=15, help="samples per stage")
+    arg_parser.add_argument("--save", metavar="PATH", help="write the results as a JSON baseline")
+    arg_parser.add_argument("--compare", metavar="PATH", help="compare against a saved JSON baseline")
+    arg_parser.add_argument("--threshold", type=float, default=0.25,
+                            help="allowed relative slowdown per stage before failing (0.25 = 25%%)")
+    arg_parser.add_argument("--min-delta", type=float, default=0.01,
+                            help="smallest median slowdown in ms that can fail a stage")
+    args = arg_parser.parse_args()
+
+    stages, loop = build_stages()
+    reference_number = calls_per_sample(reference_workload)
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "stages": {}
+    }
+
+    print(f"{'stage':<58}{'median ms':>10}{'min ms':>10}{'relative':>10}{'spread':>8}{'peak KB':>10}{'alloc KB':>10}")
+    try:
+        for name, func in stages.items():
+            stats = measure(func, args.repeat, reference_number)
+            results["stages"][name] = stats
+            print(f"{name:<58}{stats['median_ms']:>10.3f}{stats['min_ms']:>10.3f}{stats['relative']:>10.3f}"
+                  f"{stats['spread']:>8.0%}{stats['peak_kb']:>10.1f}{stats['allocated_kb']:>10.1f}")
+    finally:
+        bot.shutdown_menu_executor()
+        loop.close()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nbaseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) slower than baseline by more than allowed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
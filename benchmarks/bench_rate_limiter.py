@@ -0,0 +1,148 @@
+"""
+Unit benchmark for rate_limit.ChatRateLimiter against the previous
+USER_LAST_REQUEST/USER_PROCESSING approach (an unbounded defaultdict of
+last request times plus a set of chats in flight).
+
+A simulated clock drives a stream of requests from --chats distinct chats
+(plus a small group of chats that come back repeatedly). For each
+implementation it reports the cost of one check + release (timed without
+tracemalloc, GC off), the number of tracked chats and the memory they
+hold (tracemalloc, on a second identical run) at the end.
+
+    python benchmarks/bench_rate_limiter.py --chats 1000000 --requests-per-second 200
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rate_limit import ChatRateLimiter  # noqa: E402
+
+REQUEST_COOLDOWN = 2
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LegacyRateLimiter:
+    """The previous bot.py logic: fixed cooldown, nothing is ever forgotten."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.last_request = defaultdict(float)
+        self.processing = set()
+
+    def acquire(self, chat_id):
+        now = self.clock()
+        if chat_id in self.processing:
+            return False, "processing"
+        last_request_time = self.last_request.get(chat_id, 0)
+        if now - last_request_time < REQUEST_COOLDOWN:
+            return False, f"cooldown:{REQUEST_COOLDOWN - (now - last_request_time):.1f}"
+        self.processing.add(chat_id)
+        self.last_request[chat_id] = now
+        return True, "allowed"
+
+    def release(self, chat_id):
+        self.processing.discard(chat_id)
+
+    def size(self):
+        return len(self.last_request)
+
+
+def request_stream(chats, regulars):
+    """Yields chat_ids: every 4th request comes from one of `regulars` returning chats."""
+    for i in range(chats):
+        yield i + 10 ** 9
+        if i % 3 == 0:
+            yield i % regulars
+
+
+def replay(limiter, clock, chats, regulars, requests_per_second):
+    step = 1 / requests_per_second
+    allowed = rejected = 0
+    for chat_id in request_stream(chats, regulars):
+        clock.now += step
+        is_allowed, _ = limiter.acquire(chat_id)
+        if is_allowed:
+            allowed += 1
+            limiter.release(chat_id)
+        else:
+            rejected += 1
+    return allowed, rejected
+
+
+def run(make_limiter, chats, regulars, requests_per_second):
+    """Times one replay with GC off, then measures memory on a second replay under tracemalloc."""
+    clock = SimulatedClock()
+    limiter = make_limiter(clock)
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        allowed, rejected = replay(limiter, clock, chats, regulars, requests_per_second)
+        elapsed = time.perf_counter() - started
+    finally:
+        gc.enable()
+    del limiter
+
+    clock = SimulatedClock()
+    limiter = make_limiter(clock)
+    gc.collect()
+    tracemalloc.start()
+    replay(limiter, clock, chats, regulars, requests_per_second)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = allowed + rejected
+    return limiter, {
+        "requests": total,
+        "allowed": allowed,
+        "rejected": rejected,
+        "ns_per_request": elapsed / total * 1e9,
+        "memory_mb": current / 2 ** 20,
+        "peak_mb": peak / 2 ** 20
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--chats", type=int, default=300000, help="distinct chats sending one request each")
+    arg_parser.add_argument("--regulars", type=int, default=500, help="chats that keep coming back")
+    arg_parser.add_argument("--requests-per-second", type=float, default=200, help="simulated request rate")
+    arg_parser.add_argument("--burst", type=int, default=2, help="token bucket burst of ChatRateLimiter")
+    arg_parser.add_argument("--max-chats", type=int, default=100000, help="store cap of ChatRateLimiter")
+    args = arg_parser.parse_args()
+
+    print(f"{'implementation':<18}{'requests':>10}{'allowed':>10}{'rejected':>10}{'ns/req':>9}"
+          f"{'tracked':>10}{'memory MB':>11}{'peak MB':>9}")
+
+    legacy, result = run(LegacyRateLimiter, args.chats, args.regulars, args.requests_per_second)
+    print(f"{'legacy':<18}{result['requests']:>10}{result['allowed']:>10}{result['rejected']:>10}"
+          f"{result['ns_per_request']:>9.0f}{legacy.size():>10}{result['memory_mb']:>11.1f}{result['peak_mb']:>9.1f}")
+    del legacy
+
+    def make_limiter(clock):
+        return ChatRateLimiter(rate=1 / REQUEST_COOLDOWN, burst=args.burst, max_chats=args.max_chats,
+                               max_in_flight=100, clock=clock)
+
+    limiter, result = run(make_limiter, args.chats, args.regulars, args.requests_per_second)
+    stats = limiter.stats()
+    print(f"{'ChatRateLimiter':<18}{result['requests']:>10}{result['allowed']:>10}{result['rejected']:>10}"
+          f"{result['ns_per_request']:>9.0f}{stats['chats']:>10}{result['memory_mb']:>11.1f}{result['peak_mb']:>9.1f}")
+    print(f"ChatRateLimiter evictions (store cap reached): {stats['evictions']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Checks the schema migrations and the indexes behind the bot's hot queries
+on SQLite (no MySQL server needed).
+
+1. Migrations: a fresh database gets every migration, a second run
+   applies nothing, and a database with the original tables (CREATE TABLE
+   IF NOT EXISTS from before migrations) is upgraded in place.
+2. Query plans: seeds --users users and --failed failed reminders, runs
+   ANALYZE, calls the bot's own query functions (recipient pages, shard
+   counts, user directory, university lookup, claiming and resolving due
+   reminders) while capturing their SQL with a before_cursor_execute
+   listener, and prints EXPLAIN QUERY PLAN for each statement.
+
+A statement fails the check if its plan scans a table without an index,
+and a query function fails it if none of its statements uses the index
+expected for it. Statements that select rows by a list of primary keys
+(WHERE id IN (...)) are exempt from the scan rule: for a long list on a
+small table SQLite may scan instead, depending only on the seed sizes.
+The exit status is 1 on any failure.
+
+    python benchmarks/check_query_plans.py --users 20000 --failed 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+import tempfile
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from sqlalchemy import event, inspect  # noqa: E402
+
+import bot  # noqa: E402
+from migrations import MIGRATIONS, apply_migrations  # noqa: E402
+
+# the tables as the bot created them before migrations (SQLite spelling)
+LEGACY_SCHEMA = [
+    """CREATE TABLE users (
+        chat_id BIGINT PRIMARY KEY,
+        university VARCHAR(50) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE failed_reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id BIGINT NOT NULL,
+        university VARCHAR(50) NOT NULL,
+        message TEXT NOT NULL,
+        retry_count INT DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        scheduled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    "CREATE INDEX chat_id ON failed_reminders (chat_id)",
+]
+
+# IN (?, ?, ...) lists of expanding parameters, shortened when printing
+EXPANDED_PARAMETERS = re.compile(r"\(\?(, \?)+\)")
+# rows picked by primary key; a scan here is SQLite's choice for the list length, not a missing index
+PRIMARY_KEY_IN_LIST = re.compile(r"WHERE id IN \(\?")
+
+# index each query has to use (None: any index, just no full table scan)
+EXPECTED_INDEXES = {
+    "recipients": "ix_users_university_chat_id",
+    "recipients (shard)": "ix_users_university_chat_id",
+    "shard counts": "ix_users_university_chat_id",
+    "user directory": "ix_users_updated_at",
+    "university lookup": None,
+    "claim due reminders": "ix_failed_reminders_due",
+    "resolve retried reminders": None,
+}
+
+
+class StatementRecorder:
+    def __init__(self, engine):
+        self.label = None
+        self.statements = []
+        event.listen(engine.sync_engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.label and not executemany:
+            self.statements.append((self.label, statement, parameters))
+
+
+def database_url(directory, name):
+    return f"sqlite+aiosqlite:///{os.path.join(directory, name)}"
+
+
+async def index_names():
+    async with bot.db_engine.connect() as conn:
+        return await conn.run_sync(lambda sync_conn: {
+            table: sorted(index["name"] for index in inspect(sync_conn).get_indexes(table))
+            for table in ("users", "failed_reminders")
+        })
+
+
+async def check_migrations(directory):
+    failures = []
+    all_versions = sorted(version for version, _, _ in MIGRATIONS)
+
+    await bot.init_db(database_url(directory, "fresh.db"))
+    first = await apply_migrations(bot.db_engine)
+    second = await apply_migrations(bot.db_engine)
+    print(f"fresh database: applied {first}, then {second or 'nothing'}")
+    if first != all_versions or second:
+        failures.append("fresh database did not migrate exactly once")
+    await bot.close_db()
+
+    await bot.init_db(database_url(directory, "legacy.db"))
+    async with bot.db_engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            await conn.exec_driver_sql(statement)
+    applied = await apply_migrations(bot.db_engine)
+    indexes = await index_names()
+    print(f"legacy database: applied {applied}, indexes {indexes}")
+    for expected in ("ix_users_university_chat_id", "ix_users_updated_at", "ix_failed_reminders_due"):
+        if not any(expected in names for names in indexes.values()):
+            failures.append(f"legacy database is missing {expected}")
+    await bot.close_db()
+    return failures
+
+
+async def seed(users, failed):
+    universities = list(bot.UNIVERSITY_CONFIG)
+    now = bot.utc_now()
+    async with bot.db_engine.begin() as conn:
+        await conn.execute(bot.users_table.insert(), [
+            {"chat_id": 10 ** 9 + i, "university": universities[i % len(universities)],
+             "updated_at": now - timedelta(seconds=i)}
+            for i in range(users)
+        ])
+        await conn.execute(bot.failed_reminders_table.insert(), [
+            {"chat_id": 10 ** 9 + i, "university": universities[i % len(universities)], "message": "reminder",
+             "retry_count": i % (bot.MAX_RETRIES + 1), "scheduled_at": now + timedelta(minutes=i % 120 - 60)}
+            for i in range(failed)
+        ])
+        await conn.exec_driver_sql("ANALYZE")
+
+
+async def run_queries(recorder, users):
+    university = next(iter(bot.UNIVERSITY_CONFIG))
+    page_size = max(users // len(bot.UNIVERSITY_CONFIG) // 2, 1)
+
+    recorder.label = "recipients"
+    [chat_id async for chat_id in bot.iter_university_recipients(university, page_size=page_size)]
+    recorder.label = "recipients (shard)"
+    [chat_id async for chat_id in bot.iter_university_recipients(university, page_size=page_size, shard=1, shards=6)]
+    recorder.label = "shard counts"
+    await bot.count_reminder_recipients(6)
+    recorder.label = "user directory"
+    await bot.load_user_directory()
+    recorder.label = "university lookup"
+    bot.USER_DIRECTORY.clear()
+    bot.user_directory_complete = False
+    await bot.get_user_university(10 ** 9)
+    recorder.label = "claim due reminders"
+    rows = await bot.claim_due_reminders(bot.RETRY_PAGE_SIZE)
+    recorder.label = "resolve retried reminders"
+    await bot.resolve_retried_reminders([row[0] for row in rows[::2]], rows[1::2])
+    recorder.label = None
+
+
+async def check_plans(recorder):
+    failures = []
+    used = {label: False for label in EXPECTED_INDEXES}
+    async with bot.db_engine.connect() as conn:
+        for label, statement, parameters in recorder.statements:
+            plan = [row[-1] for row in (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters))]
+            print(f"\n[{label}] {EXPANDED_PARAMETERS.sub('(?, ...)', ' '.join(statement.split()))}")
+            for line in plan:
+                print(f"    {line}")
+
+            full_scans = [line for line in plan if line.startswith("SCAN ") and "INDEX" not in line]
+            if full_scans and not PRIMARY_KEY_IN_LIST.search(statement):
+                failures.append(f"{label}: full table scan ({full_scans[0]})")
+            expected = EXPECTED_INDEXES[label]
+            used[label] = used[label] or not expected or any(expected in line for line in plan)
+
+    for label, was_used in used.items():
+        if not was_used:
+            failures.append(f"{label}: does not use {EXPECTED_INDEXES[label]}")
+    return failures
+
+
+async def main_async(args):
+    with tempfile.TemporaryDirectory() as directory:
+        failures = await check_migrations(directory)
+
+        await bot.init_db(database_url(directory, "plans.db"))
+        try:
+            await bot.create_required_tables()
+            await seed(args.users, args.failed)
+            recorder = StatementRecorder(bot.db_engine)
+            await run_queries(recorder, args.users)
+            failures += await check_plans(recorder)
+        finally:
+            await bot.close_db()
+
+    print()
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print("all checks passed" if not failures else f"{len(failures)} check(s) failed")
+    return 1 if failures else 0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--users", type=int, default=20000, help="users to seed")
+    arg_parser.add_argument("--failed", type=int, default=2000, help="failed reminders to seed")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
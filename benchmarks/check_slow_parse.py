@@ -0,0 +1,133 @@
+"""
+Checks that a slow menu parse does not delay other handlers.
+
+build_university_schedule is patched to sleep --parse-delay seconds
+before parsing, and the snapshot is bypassed so the HTML layouts are
+parsed. A cold food query (process_food_query_internal) is started, and
+START_DELAY later a /start (start) for another chat; the check measures
+how long after its scheduled moment /start has replied:
+
+- "menu executor": the bot as it runs, the parse is in the thread pool
+  (MENU_EXECUTOR_KIND=thread, the patch is not seen by a process pool);
+- "inline": the same load run on the event loop thread, for comparison.
+
+The exit status is 1 if /start takes longer than --max-latency with the
+menu executor.
+
+    python benchmarks/check_slow_parse.py --parse-delay 2 --max-latency 0.1
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from concurrent.futures import Executor, Future
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import bot  # noqa: E402
+
+UNIVERSITY = "خوارزمی"
+# /start arrives while the food query's menu load is running
+START_DELAY = 0.05
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append(text)
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    def __init__(self, chat_id, text):
+        self.effective_chat = FakeChat(chat_id)
+        self.message = FakeMessage(text)
+
+
+class InlineExecutor(Executor):
+    """Runs the call on the event loop thread, as menus were loaded before the menu executor."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+async def run_case():
+    bot.MENU_CACHE.clear()
+    bot.REPLY_CACHE.clear()
+    food_query = FakeUpdate(1, "غذای امروز؟")
+    command = FakeUpdate(2, "/start")
+
+    async def run_food_query():
+        await bot.process_food_query_internal(food_query, None)
+        return time.perf_counter() - started
+
+    async def run_start():
+        await asyncio.sleep(START_DELAY)
+        await bot.start(command, None)
+        return time.perf_counter() - started - START_DELAY
+
+    started = time.perf_counter()
+    food_seconds, start_seconds = await asyncio.gather(run_food_query(), run_start())
+    assert food_query.message.replies and command.message.replies, "a handler sent no reply"
+    return food_seconds, start_seconds
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--parse-delay", type=float, default=2.0, help="seconds added to every parse")
+    arg_parser.add_argument("--max-latency", type=float, default=0.1,
+                            help="longest acceptable /start time next to a slow parse, in seconds")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    build_university_schedule = bot.build_university_schedule
+
+    def slow_build_university_schedule(*call_args, **kwargs):
+        time.sleep(args.parse_delay)
+        return build_university_schedule(*call_args, **kwargs)
+
+    bot.build_university_schedule = slow_build_university_schedule
+    bot.MENU_EXECUTOR_KIND = "thread"
+    bot.USER_DIRECTORY[1] = UNIVERSITY
+    sources = bot.MENU_SOURCES[UNIVERSITY]
+    bot.MENU_SOURCES[UNIVERSITY] = {**sources, "snapshot": os.path.join(ROOT, "layouts", "missing-snapshot.json")}
+
+    get_menu_executor = bot.get_menu_executor
+    inline_executor = InlineExecutor()
+    cases = [("menu executor", get_menu_executor), ("inline", lambda: inline_executor)]
+    results = {}
+    try:
+        for name, get_executor in cases:
+            bot.get_menu_executor = get_executor
+            results[name] = asyncio.run(run_case())
+    finally:
+        bot.get_menu_executor = get_menu_executor
+        bot.MENU_SOURCES[UNIVERSITY] = sources
+        bot.shutdown_menu_executor()
+
+    print(f"{'case':<15}{'food query s':>14}{'/start s':>10}")
+    for name, (food_seconds, start_seconds) in results.items():
+        print(f"{name:<15}{food_seconds:>14.3f}{start_seconds:>10.3f}")
+
+    start_seconds = results["menu executor"][1]
+    if start_seconds > args.max_latency:
+        print(f"FAIL /start took {start_seconds:.3f}s next to a {args.parse_delay}s parse")
+        sys.exit(1)
+    print(f"ok: /start replied in {start_seconds * 1000:.1f} ms while the menu was parsed")
+
+
+if __name__ == "__main__":
+    main()
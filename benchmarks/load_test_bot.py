@@ -0,0 +1,327 @@
+"""
+Load test for the bot: feeds synthetic /start, university choice,
+"غذای امروز؟" and "غذای این هفته؟" updates into the Application built by
+bot.build_application(), at a configurable rate, without network access.
+
+- Telegram is replaced by a local stand-in Bot API server (getMe,
+  sendMessage) with configurable latency.
+- The database is an in-memory SQLite engine (DATABASE_URL is ignored).
+- Updates go through application.update_queue, so PTB's own dispatching,
+  the ConversationHandler, check_rate_limit and handle_food_query are all
+  exercised.
+- RATE_LIMITER is replaced by one without cooldown (unless --rate-limit),
+  because a chat's queries are fed back to back: with the real limiter,
+  faster processing turns more of them into cheap cooldown replies and
+  runs no longer do the same work. Runs whose replies differ are flagged.
+
+For every level of --users it reports throughput and p50/p95/p99 latency
+(update queued -> all handlers done) per update kind, plus the replies
+grouped by type, so you can see where latency climbs with more users.
+Each --concurrent-updates value gets its own Application, so sequential
+and concurrent processing can be compared; updates of a chat finishing
+out of order are counted as ordering violations. The peak number of update
+tasks (bounded by --max-pending) and of queued updates (--queue-size) shows
+the backpressure: once both are full, feeding updates waits.
+
+    python benchmarks/load_test_bot.py --users 10,100,500 --rate 200 --queries 4 --api-latency 20
+    python benchmarks/load_test_bot.py --users 200 --concurrent-updates 1,8,32
+    python benchmarks/load_test_bot.py --users 500 --rate 5000 --max-pending 64 --queue-size 100
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationHandlerStop, TypeHandler  # noqa: E402
+
+import bot  # noqa: E402
+from rate_limit import ChatRateLimiter  # noqa: E402
+
+TOKEN = "123456:LOAD-TEST"
+REPLY_KINDS = [
+    ("menu", "منوی"),
+    ("cooldown", "ثانیه صبر کنید"),
+    ("processing", "در حال پردازش"),
+    ("choose", "دانشگاه خود را انتخاب کنید"),
+    ("saved", "یادآوری‌ها مطابق دانشگاه"),
+    ("closed", "غذا سرو نمی‌شود"),
+]
+
+
+# ─── Stand-in Bot API ────────────────────────────────────────────────
+class FakeBotApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.replies = Counter()
+        self.message_id = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def classify(self, text):
+        for kind, marker in REPLY_KINDS:
+            if marker in text:
+                return kind
+        return "other"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+                method = self.path.rsplit("/", 1)[-1]
+                if api.latency:
+                    time.sleep(api.latency)
+
+                if method == "getMe":
+                    result = {"id": 1, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+                elif method == "sendMessage":
+                    with api.lock:
+                        api.message_id += 1
+                        api.replies[api.classify(params.get("text", ""))] += 1
+                        message_id = api.message_id
+                    result = {
+                        "message_id": message_id,
+                        "date": int(time.time()),
+                        "chat": {"id": int(params["chat_id"]), "type": "private"},
+                        "text": params.get("text", "")
+                    }
+                else:
+                    result = True
+
+                body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ─── Synthetic updates ───────────────────────────────────────────────
+def make_update(application, update_id, chat_id, text):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return Update.de_json({"update_id": update_id, "message": message}, application.bot)
+
+
+def build_script(chat_ids, queries_per_user):
+    """Per user: /start, pick a university, then alternating today/week queries."""
+    universities = ["خوارزمی", "تهران"]
+    script = []
+    for step in range(2 + queries_per_user):
+        for chat_id in chat_ids:
+            if step == 0:
+                script.append(("start", chat_id, "/start"))
+            elif step == 1:
+                script.append(("choose", chat_id, universities[chat_id % 2]))
+            elif step % 2 == 0:
+                script.append(("today", chat_id, "غذای امروز؟"))
+            else:
+                script.append(("week", chat_id, "غذای این هفته؟"))
+    return script
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# ─── Runner ──────────────────────────────────────────────────────────
+async def run_level(application, api, users, first_chat_id, rate, queries_per_user):
+    chat_ids = list(range(first_chat_id, first_chat_id + users))
+    script = build_script(chat_ids, queries_per_user)
+    queued_at = {}
+    latencies = defaultdict(list)
+    kinds = {}
+    last_done = {}
+    violations = 0
+    done = asyncio.Event()
+    api.replies.clear()
+
+    async def record_done(update, context):
+        nonlocal violations
+        update_id = update.update_id
+        if update_id in queued_at:
+            latencies[kinds[update_id]].append(time.perf_counter() - queued_at.pop(update_id))
+            chat_id = update.effective_chat.id
+            if last_done.get(chat_id, -1) > update_id:
+                violations += 1
+            last_done[chat_id] = update_id
+            if not queued_at and len(kinds) == len(script):
+                done.set()
+        raise ApplicationHandlerStop
+
+    recorder = TypeHandler(Update, record_done)
+    application.add_handler(recorder, group=99)
+
+    peaks = {"pending": 0, "queued": 0}
+
+    async def sample_backlog():
+        while True:
+            pending = sum(1 for task in asyncio.all_tasks() if task.get_name().endswith("process_concurrent_update"))
+            peaks["pending"] = max(peaks["pending"], pending)
+            peaks["queued"] = max(peaks["queued"], application.update_queue.qsize())
+            await asyncio.sleep(0.005)
+
+    sampler = asyncio.create_task(sample_backlog())
+    put_wait = 0.0
+
+    started = time.perf_counter()
+    for i, (kind, chat_id, text) in enumerate(script):
+        target = started + i / rate
+        delay = target - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update_id = first_chat_id * 10 + i
+        kinds[update_id] = kind
+        queued_at[update_id] = time.perf_counter()
+        await application.update_queue.put(make_update(application, update_id, chat_id, text))
+        put_wait += time.perf_counter() - queued_at[update_id]
+
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    application.remove_handler(recorder, group=99)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "users": users,
+        "updates": len(script),
+        "elapsed": elapsed,
+        "throughput": len(script) / elapsed,
+        "latency": {kind: values for kind, values in latencies.items()},
+        "all": all_latencies,
+        "replies": dict(api.replies),
+        "ordering_violations": violations,
+        "peak_pending": peaks["pending"],
+        "peak_queued": peaks["queued"],
+        "put_wait": put_wait
+    }
+
+
+def print_level(result):
+    print(f"\n=== {result['users']} users: {result['updates']} updates in {result['elapsed']:.2f}s "
+          f"-> {result['throughput']:.1f} updates/s")
+    print(f"  {'kind':<8}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = list(result["latency"].items()) + [("all", result["all"])]
+    for kind, values in rows:
+        print(f"  {kind:<8}{len(values):>7}{percentile(values, 50) * 1000:>10.1f}"
+              f"{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}"
+              f"{max(values) * 1000:>10.1f}")
+    print(f"  replies: {', '.join(f'{k}={v}' for k, v in sorted(result['replies'].items()))}")
+    print(f"  per-chat ordering violations: {result['ordering_violations']}")
+    print(f"  peak update tasks: {result['peak_pending']} (max {bot.MAX_PENDING_UPDATES}), "
+          f"peak queued: {result['peak_queued']} (max {bot.UPDATE_QUEUE_SIZE}), "
+          f"feeding waited {result['put_wait']:.2f}s")
+
+
+async def main_async(args):
+    api = FakeBotApi(args.api_latency / 1000)
+    base_url = api.start()
+
+    await bot.init_db("sqlite+aiosqlite:///:memory:")
+    await bot.create_required_tables()
+    bot.user_directory_complete = True
+
+    results = []
+    first_chat_id = 1000
+    try:
+        for concurrent_updates in args.concurrent_updates:
+            print(f"\n##### concurrent updates: {concurrent_updates}")
+            application = bot.build_application(token=TOKEN, base_url=base_url, concurrent_updates=concurrent_updates)
+            bot.bot_app = application
+            await application.initialize()
+            await application.start()
+            try:
+                for users in args.users:
+                    result = await run_level(application, api, users, first_chat_id, args.rate, args.queries)
+                    result["concurrent_updates"] = concurrent_updates
+                    print_level(result)
+                    results.append(result)
+                    first_chat_id += users + 1000
+            finally:
+                await application.stop()
+                await application.shutdown()
+    finally:
+        bot.shutdown_menu_executor()
+        await bot.close_db()
+        api.stop()
+
+    print(f"\n{'concurrent':>10}{'users':>7}{'updates/s':>11}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        print(f"{result['concurrent_updates']:>10}{result['users']:>7}{result['throughput']:>11.1f}"
+              f"{percentile(result['all'], 50) * 1000:>10.1f}{percentile(result['all'], 95) * 1000:>10.1f}"
+              f"{percentile(result['all'], 99) * 1000:>10.1f}")
+
+    for users in args.users:
+        mixes = {result["concurrent_updates"]: result["replies"] for result in results if result["users"] == users}
+        if len({tuple(sorted(replies.items())) for replies in mixes.values()}) > 1:
+            print(f"WARNING {users} users: the replies differ between runs, so their throughput is not comparable: "
+                  + "; ".join(f"{concurrent}: {replies}" for concurrent, replies in mixes.items()))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--users", default="10,50,200",
+                            help="comma separated numbers of concurrent users, one run per level")
+    arg_parser.add_argument("--rate", type=float, default=200, help="updates per second fed into the bot")
+    arg_parser.add_argument("--queries", type=int, default=4, help="food queries per user after choosing")
+    arg_parser.add_argument("--api-latency", type=float, default=20, help="stand-in Bot API latency in ms")
+    arg_parser.add_argument("--concurrent-updates", default=str(bot.CONCURRENT_UPDATES),
+                            help="comma separated CONCURRENT_UPDATES values, one Application per value")
+    arg_parser.add_argument("--max-pending", type=int, default=bot.MAX_PENDING_UPDATES,
+                            help="MAX_PENDING_UPDATES, updates processed at once")
+    arg_parser.add_argument("--queue-size", type=int, default=bot.UPDATE_QUEUE_SIZE,
+                            help="UPDATE_QUEUE_SIZE, updates waiting in the update queue")
+    arg_parser.add_argument("--rate-limit", action="store_true",
+                            help="keep the bot's RATE_LIMITER (back to back queries get cooldown replies)")
+    args = arg_parser.parse_args()
+    bot.MAX_PENDING_UPDATES = args.max_pending
+    bot.UPDATE_QUEUE_SIZE = args.queue_size
+    if not args.rate_limit:
+        bot.RATE_LIMITER = ChatRateLimiter(rate=1e9, max_chats=bot.RATE_LIMIT_MAX_CHATS, max_in_flight=10 ** 9)
+    args.users = [int(users) for users in args.users.split(",")]
+    args.concurrent_updates = [int(value) for value in args.concurrent_updates.split(",")]
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Replays recorded Telegram update payloads (one JSON update per line) by
+POSTing them to a webhook listener, the way Telegram does, and reports
+the acknowledgement latency of the listener.
+
+Without --url the bot is hosted in-process in webhook mode, against the
+load test's local stand-in Bot API and an in-memory SQLite database, and
+the run also waits until every update has been answered. With --url the
+updates are sent to an already running bot (BOT_MODE=webhook).
+
+--copies replays the file for that many distinct chats (chat and update
+ids are shifted per copy) with --concurrency requests in flight.
+
+    python benchmarks/replay_webhook_updates.py --copies 200 --concurrency 20
+    python benchmarks/replay_webhook_updates.py --url http://127.0.0.1:8443/telegram --secret "$WEBHOOK_SECRET_TOKEN"
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import socket
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+import bot  # noqa: E402
+from load_test_bot import TOKEN, FakeBotApi, percentile  # noqa: E402
+
+DEFAULT_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "webhook_updates.jsonl")
+CHAT_ID_STEP = 1000000
+
+
+def load_updates(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def shifted(update, copy_index, update_count):
+    """The same update for another chat: chat/user ids and update_id are shifted by copy_index."""
+    update = copy.deepcopy(update)
+    update["update_id"] += copy_index * update_count
+    for field in ("message", "edited_message"):
+        message = update.get(field)
+        if message:
+            message["chat"]["id"] += copy_index * CHAT_ID_STEP
+            if "from" in message:
+                message["from"]["id"] += copy_index * CHAT_ID_STEP
+    return update
+
+
+async def replay(url, secret, updates, copies, concurrency):
+    """Each copy is replayed in order (like a real chat); copies run concurrently."""
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def replay_copy(copy_index):
+            async with semaphore:
+                for update in updates:
+                    payload = shifted(update, copy_index, len(updates))
+                    started = time.perf_counter()
+                    response = await client.post(url, content=json.dumps(payload), headers=headers)
+                    latencies.append(time.perf_counter() - started)
+                    statuses[response.status_code] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(replay_copy(i) for i in range(copies)))
+        elapsed = time.perf_counter() - started
+    return statuses, latencies, elapsed
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def self_hosted(args, updates):
+    api = FakeBotApi(args.api_latency / 1000)
+    base_url = api.start()
+    await bot.init_db("sqlite+aiosqlite:///:memory:")
+    await bot.create_required_tables()
+    bot.user_directory_complete = True
+
+    application = bot.build_application(token=TOKEN, base_url=base_url)
+    bot.bot_app = application
+    port = free_port()
+    secret = "local-replay-secret"
+    await application.initialize()
+    # setWebhook goes to the stand-in Bot API
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=port,
+        url_path=bot.WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=bot.ALLOWED_UPDATES
+    )
+    await application.start()
+
+    try:
+        expected_replies = sum(1 for update in updates if "message" in update) * args.copies
+        url = f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}"
+        first_post = time.perf_counter()
+        statuses, latencies, elapsed = await replay(url, secret, updates, args.copies, args.concurrency)
+
+        # replies are sent by the handlers after the listener acknowledged the update
+        deadline = time.perf_counter() + 60
+        while sum(api.replies.values()) < expected_replies and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        answered = time.perf_counter()
+        report(statuses, latencies, elapsed)
+        print(f"all {sum(api.replies.values())}/{expected_replies} replies sent "
+              f"{answered - first_post:.2f}s after the first POST; "
+              f"replies: {', '.join(f'{k}={v}' for k, v in sorted(api.replies.items()))}")
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        bot.shutdown_menu_executor()
+        await bot.close_db()
+        api.stop()
+
+
+def report(statuses, latencies, elapsed):
+    print(f"{len(latencies)} POSTs in {elapsed:.2f}s -> {len(latencies) / elapsed:.1f} updates/s; "
+          f"status: {', '.join(f'{k}={v}' for k, v in sorted(statuses.items()))}")
+    print(f"ack latency ms: p50 {percentile(latencies, 50) * 1000:.1f}  p95 {percentile(latencies, 95) * 1000:.1f}  "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}  max {max(latencies) * 1000:.1f}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--updates", default=DEFAULT_UPDATES, help="JSON lines file of recorded updates")
+    arg_parser.add_argument("--url", help="webhook URL of a running bot (default: host the bot in-process)")
+    arg_parser.add_argument("--secret", help="X-Telegram-Bot-Api-Secret-Token of the running bot")
+    arg_parser.add_argument("--copies", type=int, default=50, help="distinct chats replaying the file")
+    arg_parser.add_argument("--concurrency", type=int, default=20, help="chats replaying at the same time")
+    arg_parser.add_argument("--api-latency", type=float, default=20, help="stand-in Bot API latency in ms")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    updates = load_updates(args.updates)
+    if args.url:
+        report(*asyncio.run(replay(args.url, args.secret, updates, args.copies, args.concurrency)))
+    else:
+        asyncio.run(self_hosted(args, updates))
+
+
+if __name__ == "__main__":
+    main()
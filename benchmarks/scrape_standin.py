@@ -0,0 +1,149 @@
+"""
+Runs scraper.scrape_menus against a local stand-in for the efood site and
+checks that menus are fetched concurrently.
+
+The stand-in serves the login page (with a __RequestVerificationToken),
+accepts the login POST and answers every menu POST with a layout from
+layouts/ after a per-menu delay (--delays, one menu per value). Menus are
+written to a temporary directory.
+
+The check fails (exit status 1) if the run takes longer than the slowest
+single fetch plus --tolerance, if menus were fetched one at a time, or if
+a second run rewrites menus that did not change.
+
+    python benchmarks/scrape_standin.py --delays 0.5,1.0,1.5 --tolerance 0.4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import scraper  # noqa: E402
+
+MENU_LAYOUT = "layouts/tehran_menu_lunch.html"
+
+
+class StandInEfood:
+    def __init__(self, delays, menu_html):
+        self.delays = delays  # restId -> seconds
+        self.menu_html = menu_html
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, text):
+                body = text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.send_body('<form><input name="__RequestVerificationToken" value="stand-in"></form>')
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+                if not self.path.startswith("/Reserves/GetReservePage"):
+                    self.send_body("ok")
+                    return
+
+                with site.lock:
+                    site.in_flight += 1
+                    site.max_in_flight = max(site.max_in_flight, site.in_flight)
+                try:
+                    time.sleep(site.delays[params["restId"]])
+                finally:
+                    with site.lock:
+                        site.in_flight -= 1
+                self.send_body(site.menu_html)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--delays", default="0.5,1.0,1.5", help="comma separated menu delays in seconds")
+    arg_parser.add_argument("--tolerance", type=float, default=0.4,
+                            help="allowed wall time above the slowest fetch, in seconds")
+    args = arg_parser.parse_args()
+    delays = [float(delay) for delay in args.delays.split(",")]
+
+    with open(MENU_LAYOUT, "r", encoding="utf-8") as f:
+        site = StandInEfood({str(i): delay for i, delay in enumerate(delays)}, f.read())
+    base_url = site.start()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        scraper.LOGIN_URL = f"{base_url}/Account/Login?ReturnUrl=%2f/"
+        scraper.MENU_REQUEST_URL = f"{base_url}/Reserves/GetReservePage"
+        scraper.USERNAME = scraper.PASSWORD = "stand-in"
+        scraper.MAX_CONCURRENT_FETCHES = max(scraper.MAX_CONCURRENT_FETCHES, len(delays))
+        scraper.MENU_CONFIGS = [
+            {
+                "output_file": os.path.join(directory, f"menu_{i}.html"),
+                "payload": {"personGroupId": "1", "restId": str(i), "isKiosk": "false"},
+                "description": f"stand-in menu {i} ({delay}s)"
+            }
+            for i, delay in enumerate(delays)
+        ]
+
+        try:
+            started = time.monotonic()
+            changed_files = scraper.scrape_menus()
+            elapsed = time.monotonic() - started
+            unchanged_run = scraper.scrape_menus()
+        finally:
+            site.stop()
+
+        saved = [config["output_file"] for config in scraper.MENU_CONFIGS if os.path.exists(config["output_file"])]
+
+    print(f"\nfirst run: {elapsed:.2f}s for {len(delays)} menus "
+          f"(slowest fetch {max(delays)}s, sequential {sum(delays)}s), "
+          f"{site.max_in_flight} fetched at once, {len(changed_files or ())} changed")
+    print(f"second run: {len(unchanged_run or ())} changed")
+
+    if changed_files is None or len(saved) != len(delays) or len(changed_files) != len(delays):
+        failures.append("not every menu was fetched and saved")
+    if elapsed > max(delays) + args.tolerance:
+        failures.append(f"took {elapsed:.2f}s, more than the slowest fetch ({max(delays)}s) + {args.tolerance}s")
+    if len(delays) > 1 and site.max_in_flight < 2:
+        failures.append("menus were fetched one at a time")
+    if unchanged_run is None or unchanged_run:
+        failures.append("the second run did not skip unchanged menus")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
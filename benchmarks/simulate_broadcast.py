@@ -0,0 +1,224 @@
+"""
+Simulates a full weekly reminder cycle at scale: seeds --users users per
+university into a local database, swaps bot_app.bot for a fake bot and
+runs process_reminder_for_university for every university followed by
+retry_failed_reminders, exactly as the scheduler would.
+
+The fake bot sleeps --latency ms per send_message and answers with
+- Forbidden for a fixed --blocked fraction of chats (users who blocked the bot),
+- RetryAfter(--retry-after-ms) with probability --retry-after-rate,
+- NetworkError with probability --error-rate.
+
+Each phase reports wall time, msgs/s, outcomes, the SQL statements the
+engine issued (counted with a before_cursor_execute listener) and peak
+memory (tracemalloc with --tracemalloc, otherwise the process max RSS).
+
+The Telegram rate limits are lifted by default (--global-rate) so the run
+measures the bot's own overhead; pass --global-rate 25 to see the real
+pacing. Retry backoff is set to 0 so failed reminders are due right away.
+
+    python benchmarks/simulate_broadcast.py --users 100000 --latency 30 --blocked 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from sqlalchemy import event, func, select  # noqa: E402
+from telegram.error import Forbidden, NetworkError, RetryAfter  # noqa: E402
+
+import bot  # noqa: E402
+
+SEED_CHUNK = 10000
+
+
+class FakeBot:
+    """Stands in for telegram.Bot.send_message with configurable latency and failures."""
+
+    def __init__(self, latency, blocked, error_rate, retry_after_rate, retry_after, seed):
+        self.latency = latency
+        self.blocked = blocked
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.outcomes = Counter()
+
+    def is_blocked(self, chat_id):
+        # stable per chat, so a blocked user stays blocked across retries
+        return random.Random(chat_id).random() < self.blocked
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.is_blocked(chat_id):
+            self.outcomes["forbidden"] += 1
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        roll = self.random.random()
+        if roll < self.retry_after_rate:
+            self.outcomes["retry_after"] += 1
+            raise RetryAfter(self.retry_after)
+        if roll < self.retry_after_rate + self.error_rate:
+            self.outcomes["network_error"] += 1
+            raise NetworkError("simulated network error")
+        self.outcomes["delivered"] += 1
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.counts = Counter()
+        event.listen(engine.sync_engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.counts[statement.lstrip().split(None, 1)[0].upper()] += 1
+
+
+async def seed_users(users_per_university):
+    started = time.perf_counter()
+    for index, university in enumerate(bot.UNIVERSITY_CONFIG):
+        first_chat_id = (index + 1) * 10 ** 9
+        for offset in range(0, users_per_university, SEED_CHUNK):
+            rows = [
+                {"chat_id": first_chat_id + i, "university": university}
+                for i in range(offset, min(offset + SEED_CHUNK, users_per_university))
+            ]
+            async with bot.db_engine.begin() as conn:
+                await conn.execute(bot.users_table.insert(), rows)
+    return time.perf_counter() - started
+
+
+async def count_failed_reminders():
+    row = await bot.execute_query(select(func.count()).select_from(bot.failed_reminders_table), fetch="one")
+    return row[0]
+
+
+async def run_phase(name, coro_factory, fake_bot, statements, use_tracemalloc):
+    fake_bot.outcomes.clear()
+    statements.counts.clear()
+    if use_tracemalloc:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    await coro_factory()
+    elapsed = time.perf_counter() - started
+
+    peak_mb = None
+    if use_tracemalloc:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    outcomes = dict(fake_bot.outcomes)
+    attempts = sum(outcomes.values())
+    return {
+        "phase": name,
+        "elapsed_s": elapsed,
+        "attempts": attempts,
+        "delivered": outcomes.get("delivered", 0),
+        "msgs_per_s": outcomes.get("delivered", 0) / elapsed if elapsed > 0 else 0.0,
+        "outcomes": outcomes,
+        "statements": dict(statements.counts),
+        "statements_total": sum(statements.counts.values()),
+        "tracemalloc_peak_mb": peak_mb,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "failed_reminders_rows": await count_failed_reminders()
+    }
+
+
+def print_phase(result):
+    memory = (f"tracemalloc peak {result['tracemalloc_peak_mb']:.1f} MB"
+              if result["tracemalloc_peak_mb"] is not None else f"max RSS {result['max_rss_mb']:.1f} MB")
+    print(f"\n=== {result['phase']}")
+    print(f"  wall time   {result['elapsed_s']:.2f}s")
+    print(f"  delivered   {result['delivered']} of {result['attempts']} attempts -> {result['msgs_per_s']:.1f} msgs/s")
+    print(f"  outcomes    {', '.join(f'{k}={v}' for k, v in sorted(result['outcomes'].items()))}")
+    print(f"  statements  {result['statements_total']} "
+          f"({', '.join(f'{k}={v}' for k, v in sorted(result['statements'].items()))})")
+    print(f"  memory      {memory}")
+    print(f"  failed_reminders rows after phase: {result['failed_reminders_rows']}")
+
+
+async def main_async(args):
+    db_url = args.db_url
+    tmp_dir = None
+    if not db_url:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_url = f"sqlite+aiosqlite:///{os.path.join(tmp_dir.name, 'simulate_broadcast.db')}"
+
+    bot.BROADCAST_GLOBAL_RATE = args.global_rate
+    bot.BROADCAST_CONCURRENCY = args.concurrency
+    bot.RETRY_BACKOFF_BASE = 0
+
+    fake_bot = FakeBot(args.latency / 1000, args.blocked, args.error_rate, args.retry_after_rate,
+                       args.retry_after_ms / 1000, args.seed)
+    bot.bot_app = SimpleNamespace(bot=fake_bot)
+
+    await bot.init_db(db_url)
+    try:
+        await bot.create_required_tables()
+        seed_time = await seed_users(args.users)
+        total_users = args.users * len(bot.UNIVERSITY_CONFIG)
+        print(f"seeded {total_users} users ({args.users} per university) into {db_url} in {seed_time:.1f}s")
+
+        statements = StatementCounter(bot.db_engine)
+        results = []
+
+        async def reminders():
+            for university in bot.UNIVERSITY_CONFIG:
+                await bot.process_reminder_for_university(university)
+
+        results.append(await run_phase("reminder broadcast", reminders, fake_bot, statements, args.tracemalloc))
+        print_phase(results[-1])
+        results.append(await run_phase("retry_failed_reminders", bot.retry_failed_reminders,
+                                       fake_bot, statements, args.tracemalloc))
+        print_phase(results[-1])
+    finally:
+        await bot.close_db()
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "phases": results}, f, indent=2)
+        print(f"\nresults written to {args.json}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--users", type=int, default=100000, help="users seeded per university")
+    arg_parser.add_argument("--db-url", help="async SQLAlchemy URL of an empty database (default: temporary SQLite file)")
+    arg_parser.add_argument("--latency", type=float, default=30, help="fake send_message latency in ms")
+    arg_parser.add_argument("--blocked", type=float, default=0.05, help="fraction of chats answering Forbidden")
+    arg_parser.add_argument("--error-rate", type=float, default=0.01, help="probability of a NetworkError per send")
+    arg_parser.add_argument("--retry-after-rate", type=float, default=0.001,
+                            help="probability of a RetryAfter per send")
+    arg_parser.add_argument("--retry-after-ms", type=float, default=200, help="RetryAfter duration in ms")
+    arg_parser.add_argument("--global-rate", type=float, default=1000000,
+                            help="broadcast token bucket rate in msg/s (25 = production)")
+    arg_parser.add_argument("--concurrency", type=int, default=bot.BROADCAST_CONCURRENCY, help="broadcast workers")
+    arg_parser.add_argument("--seed", type=int, default=1, help="random seed for the fake bot")
+    arg_parser.add_argument("--tracemalloc", action="store_true",
+                            help="measure peak Python memory per phase (slower)")
+    arg_parser.add_argument("--log-level", default="CRITICAL", help="logging level of the bot during the run")
+    arg_parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,22 @@ from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import CallbackQueryHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from bs4 import BeautifulSoup
 from datetime import datetime
 from telegram.ext import Application
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import os
 import time
+import hashlib
+import json
 import signal
 import sys
 import logging
 import asyncio
-from datetime import datetime, timedelta
-from telegram.ext import PicklePersistence
-
-import mysql.connector
-from mysql.connector import pooling
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from telegram.ext import BasePersistence, PersistenceInput
 
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -27,6 +26,12 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy import Column, Integer, String
+from sqlalchemy import BigInteger, Index, MetaData, Table, Text, TIMESTAMP, bindparam, func, text
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import URL
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (
@@ -40,6 +45,13 @@ from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
 
 from dotenv import load_dotenv
 
+import metrics
+from migrations import apply_migrations
+from broadcast import BroadcastCursor, BroadcastLimiter, run_broadcast
+from rate_limit import ChatRateLimiter
+from update_processor import BoundedUpdateQueue, ChatOrderedUpdateProcessor
+from menu_parser import MENU_SOURCES, build_university_schedule, load_snapshot
+
 load_dotenv()
 
 # ─── CONFIG ──────────────────────────────────────────────────────
@@ -64,23 +76,98 @@ SQLALCHEMY_URL = (
     f"@{MYSQL_CONFIG['host']}:{MYSQL_CONFIG['port']}/{MYSQL_CONFIG['database']}"
 )
 
+# Async database used by the bot itself. Set DATABASE_URL to e.g.
+# "sqlite+aiosqlite:///bot.db" to run without a MySQL server.
+DATABASE_URL = os.getenv("DATABASE_URL") or URL.create(
+    "mysql+aiomysql",
+    username=MYSQL_CONFIG["user"],
+    password=MYSQL_CONFIG["password"],
+    host=MYSQL_CONFIG["host"],
+    port=MYSQL_CONFIG["port"],
+    database=MYSQL_CONFIG["database"]
+)
+JOBSTORE_URL = os.getenv("JOBSTORE_URL", SQLALCHEMY_URL)
+
 MAX_RETRIES = 3
+DB_RETRY_DELAY = 1
 DB_RECONNECT_INTERVAL = 60
 
-# Batching and Delay Configuration
-BATCH_SIZE = 50
-DELAY_BETWEEN_MESSAGES = 0.1
-DELAY_BETWEEN_BATCHES = 1
-
-RETRY_BATCH_SIZE = 20
-RETRY_DELAY_BETWEEN_MESSAGES = 0.2
-RETRY_DELAY_BETWEEN_BATCHES = 2
+# A background supervisor pings idle pooled connections every DB_HEALTH_CHECK_INTERVAL seconds,
+# replaces them before they reach DB_POOL_RECYCLE seconds and keeps the pool filled, so checkout
+# in handlers never validates or reconnects. DB_HEALTH_CHECK_FAILURES failed rounds recreate the pool.
+DB_HEALTH_CHECK_INTERVAL = int(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+DB_HEALTH_CHECK_FAILURES = 3
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+
+# Broadcast Configuration (Telegram: ~30 msg/s overall, 1 msg/s per chat)
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PAGE_SIZE = 1000
+
+# Each university's reminders go out in REMINDER_SLOTS shards (|chat_id| % slots) spread over
+# REMINDER_WINDOW_MINUTES; universities with the same start time are interleaved in the window
+REMINDER_WINDOW_MINUTES = int(os.getenv("REMINDER_WINDOW_MINUTES", "30"))
+REMINDER_SLOTS = int(os.getenv("REMINDER_SLOTS", "6"))
+REMINDER_JITTER_SECONDS = int(os.getenv("REMINDER_JITTER_SECONDS", "30"))
+
+# Failed reminders are buffered and inserted in bulk
+FAILED_REMINDER_FLUSH_SIZE = 500
+FAILED_REMINDER_FLUSH_INTERVAL = 5
+
+# Failed reminders are retried when due (scheduled_at), with exponential backoff; the ones that
+# used up MAX_RETRIES are kept with scheduled_at NULL, out of the due range of ix_failed_reminders_due
+RETRY_PAGE_SIZE = 200
+RETRY_BACKOFF_BASE = 300
+RETRY_CLAIM_LEASE = 600
+RETRY_POLL_INTERVAL_MINUTES = 1
+
+# Menu loading/parsing runs off the event loop ("thread" or "process" pool)
+MENU_EXECUTOR_KIND = os.getenv("MENU_EXECUTOR_KIND", "thread")
+MENU_EXECUTOR_WORKERS = int(os.getenv("MENU_EXECUTOR_WORKERS", "2"))
+
+# In-memory chat_id -> university directory (LRU bounded)
+USER_DIRECTORY_MAX_SIZE = int(os.getenv("USER_DIRECTORY_MAX_SIZE", "200000"))
+
+# Conversation states are written to the database in batches of changed keys
+PERSISTENCE_UPDATE_INTERVAL = 60
+PERSISTENCE_FLUSH_SIZE = 500
+
+# Update delivery: "polling" or "webhook" (Telegram POSTs updates to WEBHOOK_URL)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public https URL ending in WEBHOOK_PATH (required)
+# required: the listener accepts only POSTs carrying it (X-Telegram-Bot-Api-Secret-Token)
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# updates received but not yet taken for processing; when full, polling/webhook requests wait
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# updates taken from the queue and not yet handled (running or waiting for a slot or chat lock)
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "256"))
+# the bot only handles messages
+ALLOWED_UPDATES = [Update.MESSAGE]
+# updates handled at the same time (1 = one by one); a chat's updates always run in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Prometheus metrics endpoint (METRICS_PORT=0 disables it)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
 # ─── Conversation info  ─────────────────────────────────────────────────
 CHOOSING = 0
 # ─── Rate Limiting Configuration ────────────────────────────────────
-USER_LAST_REQUEST = defaultdict(float)
-USER_PROCESSING = set()
+# each chat earns one request per REQUEST_COOLDOWN seconds, up to RATE_LIMIT_BURST in a row
 REQUEST_COOLDOWN = 2
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "2"))
+RATE_LIMIT_MAX_CHATS = int(os.getenv("RATE_LIMIT_MAX_CHATS", "100000"))
+MAX_IN_FLIGHT_REQUESTS = int(os.getenv("MAX_IN_FLIGHT_REQUESTS", "100"))
+RATE_LIMITER = ChatRateLimiter(
+    rate=1 / REQUEST_COOLDOWN,
+    burst=RATE_LIMIT_BURST,
+    max_chats=RATE_LIMIT_MAX_CHATS,
+    max_in_flight=MAX_IN_FLIGHT_REQUESTS
+)
 # ─── Main Buttons ───────────────────────────────────────────────
 MAIN_MARKUP = ReplyKeyboardMarkup([
     ["تغییر دانشگاه", "غذای امروز؟"],
@@ -119,11 +206,33 @@ except ImportError:
 
     tehran_tz = pytz.timezone("Asia/Tehran")
 
-db_pool = None
+db_engine = None
+db_supervisor_task = None
+# bumped on every pool recreation; callers that saw an older generation skip their own reset
+db_pool_generation = 0
+db_pool_lock = asyncio.Lock()
+DB_POOL_STATS = {"checkouts": 0, "wait_seconds": 0.0, "recycled": 0, "invalidated": 0, "resets": 0}
 bot_app = None
+failed_reminders_flush_task = None
+FAILED_REMINDER_BUFFER = []
+BROADCAST_CURSORS = {}
+broadcast_limiter = None
+REMINDER_PLAN = []
+menu_executor = None
+MENU_CACHE = {}
+# (university, menu files signature) -> task loading that version; concurrent requests share it
+MENU_LOADS_IN_FLIGHT = {}
+MENU_LOAD_STATS = {"loads": 0, "coalesced": 0}
+REPLY_CACHE = {}
+REPLY_CACHE_STATS = {"hits": 0, "misses": 0}
+USER_DIRECTORY = OrderedDict()
+USER_DIRECTORY_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+# True when every registered user is in USER_DIRECTORY, so a miss means "not registered"
+user_directory_complete = False
+metrics_server = None
 scheduler = AsyncIOScheduler(
     jobstores={
-        'default': SQLAlchemyJobStore(url=SQLALCHEMY_URL)
+        'default': SQLAlchemyJobStore(url=JOBSTORE_URL)
     },
     job_defaults={
         'coalesce': True,
@@ -132,133 +241,570 @@ scheduler = AsyncIOScheduler(
     timezone=tehran_tz
 )
 
+# ─── Metrics ──────────────────────────────────────────────────────
+HANDLER_LATENCY = metrics.Histogram(
+    "bot_handler_duration_seconds", "Time spent in food query handlers.", ["handler"])
+RATE_LIMIT_REJECTIONS = metrics.Counter(
+    "bot_rate_limit_rejections_total", "Food queries rejected by check_rate_limit.", ["reason"])
+REQUESTS_IN_FLIGHT = metrics.Gauge("bot_requests_in_flight", "Food queries being processed right now.")
+RATE_LIMITER_CHATS = metrics.Gauge("bot_rate_limiter_chats", "Chats tracked by RATE_LIMITER.")
+RATE_LIMITER_CHATS.set_function(lambda: RATE_LIMITER.stats()["chats"])
+RATE_LIMITER_IN_FLIGHT = metrics.Gauge(
+    "bot_rate_limiter_in_flight_chats", "Chats with a food query in progress in RATE_LIMITER.")
+RATE_LIMITER_IN_FLIGHT.set_function(lambda: RATE_LIMITER.stats()["in_flight"])
+RATE_LIMITER_EVICTIONS = metrics.Counter(
+    "bot_rate_limiter_evictions_total", "Chats evicted from RATE_LIMITER (RATE_LIMIT_MAX_CHATS).")
+RATE_LIMITER_EVICTIONS.set_function(lambda: RATE_LIMITER.stats()["evictions"])
+DB_QUERY_LATENCY = metrics.Histogram(
+    "bot_db_query_duration_seconds", "Time to execute (and commit) a query, without pool wait.", ["statement"],
+    buckets=metrics.DB_BUCKETS)
+DB_POOL_WAIT = metrics.Histogram(
+    "bot_db_pool_wait_seconds", "Time to check a connection out of the pool.", buckets=metrics.DB_BUCKETS)
+DB_ERRORS = metrics.Counter("bot_db_errors_total", "Failed query attempts in execute_query.", ["statement"])
+DB_POOL_CONNECTIONS = metrics.Gauge(
+    "bot_db_pool_connections", "Pooled database connections by state (idle, checked_out, overflow).", ["state"])
+DB_POOL_EVENTS = metrics.Counter(
+    "bot_db_pool_events_total", "Pool supervisor actions (recycled, invalidated, reset).", ["event"])
+MENU_PARSE_LATENCY = metrics.Histogram(
+    "bot_menu_parse_duration_seconds", "Time to parse the menu HTML layouts of a university.", ["university"])
+MENU_LOADS = metrics.Counter("bot_menu_loads_total", "Menu loads run in the menu executor.", ["university"])
+MENU_LOADS_COALESCED = metrics.Counter(
+    "bot_menu_loads_coalesced_total", "Requests that awaited an in-flight menu load instead of loading again.",
+    ["university"])
+MENU_LOADS_RUNNING = metrics.Gauge("bot_menu_loads_in_flight", "Menu loads running right now.")
+MENU_LOADS_RUNNING.set_function(lambda: get_menu_load_stats()["in_flight"])
+MENU_LOADS_SAVED_RATE = metrics.Gauge(
+    "bot_menu_loads_saved_ratio", "Share of menu requests that awaited an in-flight load instead of loading.")
+MENU_LOADS_SAVED_RATE.set_function(lambda: get_menu_load_stats()["saved_rate"])
+REPLY_CACHE_LOOKUPS = metrics.Counter(
+    "bot_reply_cache_lookups_total", "Menu reply lookups in REPLY_CACHE by result (hit, miss).", ["result"])
+REPLY_CACHE_ENTRIES = metrics.Gauge("bot_reply_cache_entries", "Rendered menu replies in REPLY_CACHE.")
+REPLY_CACHE_ENTRIES.set_function(lambda: get_reply_cache_stats()["entries"])
+REPLY_CACHE_HIT_RATE = metrics.Gauge("bot_reply_cache_hit_ratio", "Share of menu reply lookups served from REPLY_CACHE.")
+REPLY_CACHE_HIT_RATE.set_function(lambda: get_reply_cache_stats()["hit_rate"])
+USER_DIRECTORY_LOOKUPS = metrics.Counter(
+    "bot_user_directory_lookups_total", "University lookups in USER_DIRECTORY by result (hit, miss).", ["result"])
+USER_DIRECTORY_SIZE = metrics.Gauge("bot_user_directory_size", "Users cached in USER_DIRECTORY.")
+USER_DIRECTORY_SIZE.set_function(lambda: get_user_directory_stats()["size"])
+USER_DIRECTORY_HIT_RATE = metrics.Gauge(
+    "bot_user_directory_hit_ratio", "Share of university lookups answered without the database.")
+USER_DIRECTORY_HIT_RATE.set_function(lambda: get_user_directory_stats()["hit_rate"])
+USER_DIRECTORY_EVICTIONS = metrics.Counter(
+    "bot_user_directory_evictions_total", "Users evicted from USER_DIRECTORY.")
+USER_DIRECTORY_EVICTIONS.set_function(lambda: get_user_directory_stats()["evictions"])
+BROADCAST_SENT = metrics.Counter("bot_broadcast_sent_total", "Reminders delivered.", ["university"])
+BROADCAST_FAILED = metrics.Counter("bot_broadcast_failed_total", "Reminders that failed and were queued for retry.",
+                                   ["university"])
+BROADCAST_IN_PROGRESS = metrics.Gauge(
+    "bot_broadcast_in_progress", "Reminder broadcasts (shards) of a university running now.", ["university"])
+BROADCAST_THROUGHPUT = metrics.Gauge(
+    "bot_broadcast_last_throughput", "Messages per second of the last finished broadcast.", ["university"])
+BROADCAST_DURATION = metrics.Gauge(
+    "bot_broadcast_last_duration_seconds", "Duration of the last finished broadcast.", ["university"])
+REMINDER_EXPECTED_DURATION = metrics.Gauge(
+    "bot_reminder_expected_duration_seconds", "Expected duration of each scheduled reminder slot.",
+    ["university", "shard"])
+SCHEDULER_JOBS = metrics.Counter("bot_scheduler_jobs_total", "APScheduler job runs by outcome.", ["job", "outcome"])
+
+
+def statement_kind(query):
+    """SELECT/INSERT/UPDATE/... of a text or Core statement, used as a metrics label."""
+    sql = getattr(query, "text", None)
+    if sql is not None:
+        return sql.lstrip().split(None, 1)[0].upper()
+    return getattr(query, "__visit_name__", "other").upper()
+
+
+async def start_metrics():
+    global metrics_server
+    if not METRICS_PORT or metrics_server:
+        return
+    try:
+        metrics_server = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logging.error(f"Failed to start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+
+async def stop_metrics():
+    global metrics_server
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
 
 # ─── DataBase Operations  ────────────────────────────────────────────────
-def init_db_pool():
-    global db_pool
+# Models used by the queries; the schema itself is created and changed by migrations.py
+metadata = MetaData()
+
+users_table = Table(
+    "users", metadata,
+    Column("chat_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("university", String(50), nullable=False),
+    Column("created_at", TIMESTAMP, server_default=func.current_timestamp()),
+    Column("updated_at", TIMESTAMP, server_default=func.current_timestamp(), onupdate=func.current_timestamp()),
+    Index("ix_users_university_chat_id", "university", "chat_id"),
+    Index("ix_users_updated_at", "updated_at", "chat_id", "university")
+)
+
+failed_reminders_table = Table(
+    "failed_reminders", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("chat_id", BigInteger, nullable=False, index=True),
+    Column("university", String(50), nullable=False),
+    Column("message", Text, nullable=False),
+    Column("retry_count", Integer, server_default=text("0")),
+    Column("created_at", TIMESTAMP, server_default=func.current_timestamp()),
+    Column("scheduled_at", TIMESTAMP, server_default=func.current_timestamp()),
+    Index("ix_failed_reminders_due", "scheduled_at", "retry_count")
+)
+
+conversation_states_table = Table(
+    "conversation_states", metadata,
+    Column("name", String(50), primary_key=True),
+    Column("conversation_key", String(100), primary_key=True),
+    Column("state", Integer, nullable=False),
+    Column("updated_at", TIMESTAMP, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+)
+
+
+def init_db_engine(url=None):
+    global db_engine
+    url = url or DATABASE_URL
+    options = {}
+    if not str(url).startswith("sqlite"):
+        options = {
+            "pool_size": MYSQL_CONFIG["pool_size"],
+            # backstop only: the supervisor replaces connections before they get this old
+            "pool_recycle": DB_POOL_RECYCLE,
+            "connect_args": {"connect_timeout": MYSQL_CONFIG["connect_timeout"]}
+        }
+    db_engine = create_async_engine(url, **options)
+    event.listen(db_engine.sync_engine, "connect", record_connection_start)
+    return db_engine
+
+
+def record_connection_start(dbapi_connection, connection_record):
+    connection_record.info["connected_at"] = time.monotonic()
+
+
+async def init_db(url=None):
     try:
-        logging.info("Try to connect to database pool (create)")
-        db_pool = mysql.connector.pooling.MySQLConnectionPool(**MYSQL_CONFIG)
-
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-            cursor.fetchone()
-            cursor.close()
-            conn.close()
-            logging.info("connected to database succesfully")
-            return True
-        else:
-            logging.error("cannot connect to db")
-            return False
-    except mysql.connector.Error as err:
-        logging.error(f"fatal error in connecting to pool{err}")
+        logging.info("Try to connect to database (create engine)")
+        # the persistence may already have created the engine while the Application initialized
+        if url or not db_engine:
+            init_db_engine(url)
+        await execute_query("SELECT 1", fetch="one")
+        logging.info("connected to database succesfully")
+        return True
+    except SQLAlchemyError as err:
+        logging.error(f"fatal error in connecting to database {err}")
         return False
 
 
-def get_db_connection():
-    global db_pool
-    if db_pool:
-        try:
-            conn = db_pool.get_connection()
-            if conn.is_connected():
-                return conn
-            init_db_pool()
-            return db_pool.get_connection() if db_pool else None
-        except mysql.connector.Error as err:
-            logging.error(f"pool error {err}")
-            return None
-    return None
-
-
-def execute_query(query, params=None, commit=False, fetch=None):
+async def close_db():
+    global db_engine
+    if db_engine:
+        await db_engine.dispose()
+        db_engine = None
+        logging.info("CLOSED POOL OF DB")
+
+
+async def execute_query(query, params=None, commit=False, fetch=None):
+    """Runs a SQL string with :name parameters or a SQLAlchemy statement, retrying on connection errors."""
+    if isinstance(query, str):
+        query = text(query)
+    statement = statement_kind(query)
+
     retries = 0
-    while retries < MAX_RETRIES:
+    while True:
+        generation = db_pool_generation
         try:
-            conn = get_db_connection()
-            if not conn:
-                logging.error("database connection error")
-                time.sleep(1)
-                retries += 1
-                continue
-
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-
-            result = None
-            if fetch == "one":
-                result = cursor.fetchone()
-            elif fetch == "all":
-                result = cursor.fetchall()
-
-            if commit:
-                conn.commit()
-
-            cursor.close()
-            conn.close()
-
-            return result
-        except mysql.connector.Error as err:
+            if not db_engine:
+                init_db_engine()
+
+            checkout_started = time.perf_counter()
+            async with db_engine.connect() as conn:
+                query_started = time.perf_counter()
+                DB_POOL_WAIT.observe(query_started - checkout_started)
+                DB_POOL_STATS["checkouts"] += 1
+                DB_POOL_STATS["wait_seconds"] += query_started - checkout_started
+                cursor = await conn.execute(query, params or {})
+
+                result = None
+                if fetch == "one":
+                    result = cursor.fetchone()
+                elif fetch == "all":
+                    result = cursor.fetchall()
+
+                if commit:
+                    await conn.commit()
+
+                DB_QUERY_LATENCY.labels(statement).observe(time.perf_counter() - query_started)
+                return result
+        except SQLAlchemyError as err:
+            DB_ERRORS.labels(statement).inc()
             retries += 1
             logging.error(f"خطای دیتابیس ({retries}/{MAX_RETRIES}): {err}")
             if retries >= MAX_RETRIES:
                 logging.error("maximum tries failed.")
                 raise
-            time.sleep(1)
+            if isinstance(err, DBAPIError) and err.connection_invalidated:
+                # the server dropped us: the other idle connections are likely dead too
+                await reset_db_pool(generation)
+            await asyncio.sleep(DB_RETRY_DELAY)
 
 
-def create_required_tables():
+async def create_required_tables():
+    """Brings the schema up to date by applying the pending migrations (see migrations.py)."""
     try:
-        conn = get_db_connection()
-        if not conn:
-            logging.error("fatal error in creating tables (connection error)")
-            return False
+        applied = await apply_migrations(db_engine)
+        logging.info(f"tables created successfully (migrations applied: {applied or 'none'})")
+        await park_exhausted_reminders()
+        return True
 
-        cursor = conn.cursor()
+    except SQLAlchemyError as err:
+        logging.error(f"fatal in creating tables: {err}")
+        return False
 
-        users_table = """
-        CREATE TABLE IF NOT EXISTS users (
-            chat_id BIGINT PRIMARY KEY,
-            university VARCHAR(50) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-        )
-        """
 
-        failed_reminders_table = """
-        CREATE TABLE IF NOT EXISTS failed_reminders (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            chat_id BIGINT NOT NULL,
-            university VARCHAR(50) NOT NULL,
-            message TEXT NOT NULL,
-            retry_count INT DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            scheduled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            INDEX (chat_id)
-        )
+async def save_user_university(chat_id, university):
+    if db_engine.dialect.name == "sqlite":
+        query = """
+        INSERT INTO users (chat_id, university) VALUES (:chat_id, :university)
+        ON CONFLICT (chat_id) DO UPDATE SET university = excluded.university, updated_at = CURRENT_TIMESTAMP
+        """
+    else:
+        query = """
+        INSERT INTO users (chat_id, university) VALUES (:chat_id, :university)
+        ON DUPLICATE KEY UPDATE university = VALUES(university), updated_at = CURRENT_TIMESTAMP
         """
+    await execute_query(query, {"chat_id": chat_id, "university": university}, commit=True)
 
-        cursor.execute(users_table)
-        cursor.execute(failed_reminders_table)
-        conn.commit()
-        cursor.close()
-        conn.close()
 
-        logging.info("tables created successfully")
+# ─── DB Pool Supervisor ───────────────────────────────────────────
+async def reset_db_pool(seen_generation):
+    """Replaces the pool, unless another caller already did since `seen_generation`."""
+    global db_pool_generation
+    async with db_pool_lock:
+        if seen_generation != db_pool_generation or not db_engine:
+            return False
+        await db_engine.dispose()
+        db_pool_generation += 1
+        DB_POOL_STATS["resets"] += 1
+        DB_POOL_EVENTS.labels("reset").inc()
+        logging.warning("Database pool recreated")
         return True
 
-    except mysql.connector.Error as err:
-        logging.error(f"fatal in creating tables: {err}")
+
+async def reconnect(conn):
+    """Reopens an invalidated connection in place, so its pool slot is live again before a handler takes it."""
+    try:
+        await conn.rollback()
+        await conn.execute(text("SELECT 1"))
+        return True
+    except SQLAlchemyError as e:
+        logging.warning(f"Reconnecting a pooled database connection failed: {e}")
         return False
 
 
-def clean_food_name(food):
-    return re.sub(r"(،|\(|\[)?\s*(رایگان|\d{2,3}(,\d{3})?)\s*(تومان|ریال)?\)?$", "", food).strip()
+async def check_idle_connections():
+    """Pings idle connections one at a time and reopens stale or failed ones. Returns False if every ping failed."""
+    pool = db_engine.pool
+    idle = pool.checkedin() if isinstance(pool, QueuePool) else 1
+    recycle_after = DB_POOL_RECYCLE - 2 * DB_HEALTH_CHECK_INTERVAL
+    healthy = failed = 0
+    for _ in range(idle):
+        try:
+            async with db_engine.connect() as conn:
+                raw_connection = await conn.get_raw_connection()
+                if time.monotonic() - raw_connection.info.get("connected_at", time.monotonic()) > recycle_after:
+                    await conn.invalidate()
+                    DB_POOL_STATS["recycled"] += 1
+                    DB_POOL_EVENTS.labels("recycled").inc()
+                    await reconnect(conn)
+                    continue
+                try:
+                    await conn.execute(text("SELECT 1"))
+                    healthy += 1
+                except SQLAlchemyError as e:
+                    # SQLAlchemy has invalidated the connection
+                    failed += 1
+                    DB_POOL_STATS["invalidated"] += 1
+                    DB_POOL_EVENTS.labels("invalidated").inc()
+                    logging.warning(f"Pooled database connection failed its health check: {e}")
+                    await reconnect(conn)
+        except SQLAlchemyError as e:
+            # checkout reconnects a connection that an earlier round could not reopen
+            failed += 1
+            logging.warning(f"Pooled database connection could not be reopened: {e}")
+    return healthy > 0 or not failed
+
+
+async def fill_db_pool():
+    """Opens the pool's connections while none are idle yet (at startup and after a reset)."""
+    pool = db_engine.pool
+    if not isinstance(pool, QueuePool) or pool.checkedin():
+        return
+    # idle connections are handed out before new ones are opened, so all new ones are held until the end
+    connections = []
+    try:
+        for _ in range(pool.size() - pool.checkedout()):
+            connections.append(await db_engine.connect())
+    finally:
+        for conn in connections:
+            await conn.close()
+
+
+def get_db_pool_stats():
+    stats = dict(DB_POOL_STATS)
+    stats["generation"] = db_pool_generation
+    stats["avg_wait_seconds"] = stats["wait_seconds"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    pool = db_engine.pool if db_engine else None
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), idle=pool.checkedin(), checked_out=pool.checkedout(),
+                     overflow=max(pool.overflow(), 0))
+        stats["utilization"] = pool.checkedout() / pool.size()
+    return stats
+
+
+def update_db_pool_gauges():
+    stats = get_db_pool_stats()
+    for state in ("idle", "checked_out", "overflow"):
+        if state in stats:
+            DB_POOL_CONNECTIONS.labels(state).set(stats[state])
+
+
+async def db_pool_supervisor():
+    """Background task: validates, recycles and refills pooled connections (see DB_HEALTH_CHECK_INTERVAL)."""
+    failed_rounds = 0
+    while True:
+        try:
+            healthy = await check_idle_connections()
+            if healthy:
+                await fill_db_pool()
+        except Exception as e:
+            logging.error(f"Database pool health check failed: {e}")
+            healthy = False
+
+        failed_rounds = 0 if healthy else failed_rounds + 1
+        if failed_rounds >= DB_HEALTH_CHECK_FAILURES:
+            await reset_db_pool(db_pool_generation)
+            failed_rounds = 0
+        update_db_pool_gauges()
+        await asyncio.sleep(DB_HEALTH_CHECK_INTERVAL)
+
+
+# ─── User Directory ───────────────────────────────────────────────
+def remember_user_university(chat_id, university):
+    global user_directory_complete
+    USER_DIRECTORY[chat_id] = university
+    USER_DIRECTORY.move_to_end(chat_id)
+    while len(USER_DIRECTORY) > USER_DIRECTORY_MAX_SIZE:
+        USER_DIRECTORY.popitem(last=False)
+        USER_DIRECTORY_STATS["evictions"] += 1
+        user_directory_complete = False
+
+
+async def load_user_directory():
+    """Bulk-loads the most recently updated users into USER_DIRECTORY at startup."""
+    global user_directory_complete
+    rows = await execute_query(
+        "SELECT chat_id, university FROM users ORDER BY updated_at DESC LIMIT :limit",
+        {"limit": USER_DIRECTORY_MAX_SIZE + 1},
+        fetch="all"
+    ) or []
+
+    USER_DIRECTORY.clear()
+    for chat_id, university in reversed(rows[:USER_DIRECTORY_MAX_SIZE]):
+        USER_DIRECTORY[chat_id] = university
+    user_directory_complete = len(rows) <= USER_DIRECTORY_MAX_SIZE
+    logging.info(f"User directory loaded with {len(USER_DIRECTORY)} users (complete={user_directory_complete}).")
+
+
+async def get_user_university(chat_id):
+    """University of a user from USER_DIRECTORY; the database is read only if the directory may be incomplete."""
+    university = USER_DIRECTORY.get(chat_id)
+    if university is not None:
+        USER_DIRECTORY.move_to_end(chat_id)
+        USER_DIRECTORY_STATS["hits"] += 1
+        USER_DIRECTORY_LOOKUPS.labels("hit").inc()
+        return university
+
+    if user_directory_complete:
+        USER_DIRECTORY_STATS["hits"] += 1
+        USER_DIRECTORY_LOOKUPS.labels("hit").inc()
+        return None
+
+    USER_DIRECTORY_STATS["misses"] += 1
+    USER_DIRECTORY_LOOKUPS.labels("miss").inc()
+    result = await execute_query(
+        "SELECT university FROM users WHERE chat_id = :chat_id",
+        {"chat_id": chat_id},
+        fetch="one"
+    )
+    if not result:
+        return None
+
+    remember_user_university(chat_id, result[0])
+    return result[0]
+
+
+async def set_user_university(chat_id, university):
+    """Write-through: saves to the database first, then updates USER_DIRECTORY."""
+    await save_user_university(chat_id, university)
+    remember_user_university(chat_id, university)
+
+
+def get_user_directory_stats():
+    hits = USER_DIRECTORY_STATS["hits"]
+    misses = USER_DIRECTORY_STATS["misses"]
+    total = hits + misses
+    return {
+        "size": len(USER_DIRECTORY),
+        "max_size": USER_DIRECTORY_MAX_SIZE,
+        "complete": user_directory_complete,
+        "hits": hits,
+        "misses": misses,
+        "evictions": USER_DIRECTORY_STATS["evictions"],
+        "hit_rate": hits / total if total else 0.0
+    }
+
+
+# ─── Conversation Persistence ─────────────────────────────────────
+class DatabasePersistence(BasePersistence):
+    """Stores active ConversationHandler states in conversation_states, writing only changed keys per flush."""
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.dirty = {}
+        self.flush_task = None
+        self.table_ready = False
+
+    async def ensure_table(self):
+        # the Application loads conversations before on_startup creates the tables
+        if not self.table_ready:
+            if not db_engine:
+                init_db_engine()
+            await apply_migrations(db_engine)
+            self.table_ready = True
+
+    async def get_conversations(self, name):
+        await self.ensure_table()
+        rows = await execute_query(
+            "SELECT conversation_key, state FROM conversation_states WHERE name = :name",
+            {"name": name},
+            fetch="all"
+        ) or []
+        logging.info(f"Loaded {len(rows)} active '{name}' conversations.")
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self.dirty[(name, json.dumps(list(key)))] = new_state
+        if len(self.dirty) >= PERSISTENCE_FLUSH_SIZE:
+            await self.flush_dirty()
+        elif not self.flush_task:
+            # one write for all keys handed over by the same update_persistence run
+            self.flush_task = asyncio.create_task(self.flush_dirty_soon())
+
+    async def flush_dirty_soon(self):
+        await asyncio.sleep(0)
+        self.flush_task = None
+        await self.flush_dirty()
+
+    async def flush_dirty(self):
+        if not self.dirty:
+            return 0
+        dirty, self.dirty = self.dirty, {}
+
+        upserts = [
+            {"name": name, "conversation_key": key, "state": state}
+            for (name, key), state in dirty.items() if state is not None
+        ]
+        deletes = defaultdict(list)
+        for (name, key), state in dirty.items():
+            if state is None:
+                deletes[name].append(key)
+
+        try:
+            for i in range(0, len(upserts), PERSISTENCE_FLUSH_SIZE):
+                await execute_query(upsert_conversation_states(upserts[i:i + PERSISTENCE_FLUSH_SIZE]), commit=True)
+            for name, keys in deletes.items():
+                await execute_query(
+                    text("DELETE FROM conversation_states WHERE name = :name AND conversation_key IN :keys")
+                    .bindparams(bindparam("keys", expanding=True)),
+                    {"name": name, "keys": keys},
+                    commit=True
+                )
+        except Exception as e:
+            # newer states of the same keys win over the ones that failed
+            self.dirty = {**dirty, **self.dirty}
+            logging.error(f"Error saving {len(dirty)} conversation states: {e}")
+            return 0
+        return len(dirty)
+
+    async def flush(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush_dirty()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+def upsert_conversation_states(rows):
+    if db_engine.dialect.name == "sqlite":
+        statement = sqlite.insert(conversation_states_table).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=["name", "conversation_key"],
+            set_={"state": statement.excluded.state, "updated_at": func.current_timestamp()}
+        )
+    statement = mysql.insert(conversation_states_table).values(rows)
+    return statement.on_duplicate_key_update(state=statement.inserted.state, updated_at=func.current_timestamp())
 
 
 def get_today_name():
-    today = datetime.now()
+    today = datetime.now(tehran_tz)
     weekday = today.weekday()
 
     days_mapping = {
@@ -274,114 +820,237 @@ def get_today_name():
     return days_mapping[weekday]
 
 
-def parse_food_schedule(html, university=None):
-    try:
-        soup = BeautifulSoup(html, "html.parser")
-        schedule = {}
-
-        day_containers = soup.find_all("div", class_="dayContainer")
-
-        for day_container in day_containers:
-            day_span = day_container.find(class_="day")
-            date_span = day_container.find(class_="date")
-
-            if day_span:
-                day_name = day_span.get_text(strip=True)
-                date = date_span.get_text(strip=True) if date_span else ""
-
-                schedule[day_name] = {
-                    "تاریخ": date,
-                    "صبحانه": [],
-                    "ناهار": [],
-                    "شام": []
-                }
-
-                current_element = day_container
-
-                while True:
-                    current_element = current_element.find_next_sibling()
-                    if not current_element or (
-                            current_element.get('class') and 'dayContainer' in current_element.get('class')):
-                        break
-
-                    time_meal = current_element.find("span", class_="TimeMeal")
-                    current_meal_type = None
-
-                    if time_meal:
-                        meal_text = time_meal.get_text(strip=True).lower()
-                        if "صبحانه" in meal_text:
-                            current_meal_type = "صبحانه"
-                        elif "ناهار" in meal_text or "نهار" in meal_text:
-                            current_meal_type = "ناهار"
-                        elif "شام" in meal_text:
-                            current_meal_type = "شام"
-
-                    if current_meal_type:
-                        meal_divs = current_element.find_all("div", id="MealDiv")
-                        for meal_div in meal_divs:
-                            food_labels = meal_div.find_all("label", class_="reserveFoodCheckBox")
-                            for label in food_labels:
-                                if label.get('for') and label.get_text(strip=True):
-                                    food_text = clean_food_name(label.get_text(strip=True))
-                                    if food_text and food_text not in schedule[day_name][current_meal_type]:
-                                        schedule[day_name][current_meal_type].append(food_text)
-
-        return schedule
+def format_meals(meals):
+    """قالب‌بندی وعده‌های غذایی"""
+    if not meals:
+        return "⚠️ اطلاعات منو موجود نیست"
 
-    except Exception as e:
-        print(f"خطا در خواندن برنامه غذایی: {e}")
-        return {
-            day: {"تاریخ": "", "صبحانه": [], "ناهار": [], "شام": []}
-            for day in ["شنبه", "یکشنبه", "دوشنبه", "سه شنبه", "چهارشنبه", "پنج شنبه"]
-        }
+    parts = ["🍳 صبحانه:\n"]
+    parts.extend(f"    • {f}\n" for f in meals['صبحانه'])
+    if not meals['صبحانه']:
+        parts.append("    • موجود نیست\n")
+    parts.append("🍛 ناهار:\n")
+    parts.extend(f"    • {f}\n" for f in meals['ناهار'])
+    if not meals['ناهار']:
+        parts.append("    • موجود نیست\n")
+    parts.append("🍲 شام:\n")
+    parts.extend(f"    • {f}\n" for f in meals['شام'])
+    if not meals['شام']:
+        parts.append("    • موجود نیست\n")
+    return "".join(parts)
+
+# ─── Menu Cache ───────────────────────────────────────────────────
+def get_menu_files_signature(paths):
+    """mtime و اندازه فایل‌های منو؛ برای تشخیص تغییر بدون خواندن فایل‌ها"""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+def read_menu_files(paths):
+    contents = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            contents.append(f.read())
+    return contents
+
+
+def hash_menu_contents(contents):
+    digest = hashlib.sha256()
+    for content in contents:
+        digest.update(content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_university_menu(university, known_hash=None):
+    """Runs in the menu executor: snapshot or parsed layouts as (content_hash, schedule or None, parse_seconds)."""
+    sources = MENU_SOURCES[university]
+    if os.path.exists(sources["snapshot"]):
+        snapshot = load_snapshot(sources["snapshot"])
+        if snapshot:
+            if snapshot["content_hash"] == known_hash:
+                return known_hash, None, None
+            return snapshot["content_hash"], snapshot["schedule"], None
+        logging.warning(f"Menu snapshot of {university} has another schema version, parsing HTML instead.")
+
+    contents = read_menu_files(sources["html"])
+    content_hash = hash_menu_contents(contents)
+    if content_hash == known_hash:
+        return content_hash, None, None
+    parse_started = time.perf_counter()
+    schedule = build_university_schedule(university, contents)
+    return content_hash, schedule, time.perf_counter() - parse_started
+
+
+def get_menu_executor():
+    global menu_executor
+    if menu_executor is None:
+        if MENU_EXECUTOR_KIND == "process":
+            menu_executor = ProcessPoolExecutor(max_workers=MENU_EXECUTOR_WORKERS)
+        else:
+            menu_executor = ThreadPoolExecutor(max_workers=MENU_EXECUTOR_WORKERS, thread_name_prefix="menu")
+        logging.info(f"Menu executor started ({MENU_EXECUTOR_KIND}, {MENU_EXECUTOR_WORKERS} workers).")
+    return menu_executor
 
 
-def merge_weekly_menus(menu1, menu2):
-    merged_menu = {}
-    days_order = ["شنبه", "یکشنبه", "دوشنبه", "سه شنبه", "چهارشنبه", "پنج شنبه", "جمعه"]
-    all_days = set(menu1.keys()) | set(menu2.keys())
-
-    for day in days_order:
-        if day in all_days:
-            merged_menu[day] = {
-                'تاریخ': menu1.get(day, {}).get('تاریخ', '') or menu2.get(day, {}).get('تاریخ', ''),
-                'صبحانه': menu1.get(day, {}).get('صبحانه', []),
-                'ناهار': [],
-                'شام': []
-            }
-
-            lunch_items_from_lunch_file = menu1.get(day, {}).get('ناهار', [])
-            dinner_items_from_dinner_file = menu2.get(day, {}).get('شام', [])
-
-            if day == "پنجشنبه":
-                if dinner_items_from_dinner_file and not lunch_items_from_lunch_file:
-                    merged_menu[day]['ناهار'] = dinner_items_from_dinner_file
-                    merged_menu[day]['شام'] = []
-                else:
-                    merged_menu[day]['ناهار'] = lunch_items_from_lunch_file
-                    merged_menu[day]['شام'] = dinner_items_from_dinner_file
-            else:
-                merged_menu[day]['ناهار'] = lunch_items_from_lunch_file
-                merged_menu[day]['شام'] = dinner_items_from_dinner_file
-    return merged_menu
+def shutdown_menu_executor():
+    global menu_executor
+    if menu_executor is not None:
+        menu_executor.shutdown(wait=False, cancel_futures=True)
+        menu_executor = None
 
 
-def format_meals(meals):
-    """قالب‌بندی وعده‌های غذایی"""
-    if not meals:
-        return "⚠️ اطلاعات منو موجود نیست"
+async def get_university_schedule(university):
+    """Weekly schedule of a university, reloaded (one shared load at a time) when its menu files change."""
+    sources = MENU_SOURCES[university]
+    paths = [sources["snapshot"]] + sources["html"]
+    signature = get_menu_files_signature(paths)
+
+    cached = MENU_CACHE.get(university)
+    if cached and cached["signature"] == signature:
+        return cached["schedule"]
+
+    key = (university, signature)
+    load = MENU_LOADS_IN_FLIGHT.get(key)
+    if load:
+        MENU_LOAD_STATS["coalesced"] += 1
+        MENU_LOADS_COALESCED.labels(university).inc()
+    else:
+        load = asyncio.ensure_future(refresh_university_schedule(university, signature))
+        MENU_LOADS_IN_FLIGHT[key] = load
+        load.add_done_callback(lambda task: finish_menu_load(key, task))
+    # shield: a cancelled request must not cancel the load other requests are waiting for
+    return await asyncio.shield(load)
+
+
+def finish_menu_load(key, task):
+    if MENU_LOADS_IN_FLIGHT.get(key) is task:
+        del MENU_LOADS_IN_FLIGHT[key]
+    if not task.cancelled():
+        # mark the error as retrieved even if every waiter was cancelled
+        task.exception()
+
+
+async def refresh_university_schedule(university, signature):
+    cached = MENU_CACHE.get(university)
+    known_hash = cached["content_hash"] if cached else None
+    MENU_LOAD_STATS["loads"] += 1
+    MENU_LOADS.labels(university).inc()
+
+    loop = asyncio.get_running_loop()
+    content_hash, schedule, parse_seconds = await loop.run_in_executor(
+        get_menu_executor(), load_university_menu, university, known_hash
+    )
+    if parse_seconds is not None:
+        MENU_PARSE_LATENCY.labels(university).observe(parse_seconds)
+
+    if schedule is None:
+        cached["signature"] = signature
+        return cached["schedule"]
+
+    MENU_CACHE[university] = {
+        "signature": signature,
+        "content_hash": content_hash,
+        "schedule": schedule
+    }
+    logging.info(f"Menu cache for {university} (re)built.")
+    return schedule
+
+
+def get_menu_load_stats():
+    loads = MENU_LOAD_STATS["loads"]
+    coalesced = MENU_LOAD_STATS["coalesced"]
+    return {
+        "loads": loads,
+        "coalesced": coalesced,
+        "in_flight": len(MENU_LOADS_IN_FLIGHT),
+        "saved_rate": coalesced / (loads + coalesced) if loads + coalesced else 0.0
+    }
+
+
+def get_menu_version(university):
+    cached = MENU_CACHE.get(university)
+    return cached["content_hash"] if cached else None
 
-    message = ""
-    message += "🍳 صبحانه:\n"
-    message += "".join(f"    • {f}\n" for f in meals['صبحانه']) or "    • موجود نیست\n"
-    message += "🍛 ناهار:\n"
-    message += "".join(f"    • {f}\n" for f in meals['ناهار']) or "    • موجود نیست\n"
-    message += "🍲 شام:\n"
-    message += "".join(f"    • {f}\n" for f in meals['شام']) or "    • موجود نیست\n"
-    return message
 
+# ─── Reply Cache ──────────────────────────────────────────────────
+def render_today_reply(university, schedule, today_name):
+    if today_name == "جمعه" and not schedule.get(today_name):
+        return "📵 امروز (جمعه) غذا سرو نمی‌شود."
+
+    if university == "تهران" and today_name not in schedule:
+        return f"📵 امروز ({today_name}) در دانشگاه تهران غذا سرو نمی‌شود."
+
+    meals_today = schedule.get(today_name, {})
+    header = f"🍽 منوی امروز ({today_name}) دانشگاه {university}:\n\n"
+    if not meals_today or not any(meals_today.get(m) for m in ["صبحانه", "ناهار", "شام"]):
+        return header + "⚠️ اطلاعات منو برای امروز موجود نیست یا غذا ارائه نمی‌شود."
+    return header + format_meals(meals_today)
+
+
+def render_week_reply(university, schedule):
+    header = f"🗓 منوی هفته جاری دانشگاه {university}:\n\n"
+    if not schedule:
+        return header + "⚠️ اطلاعات منوی این هفته هنوز در دسترس نیست."
+
+    parts = [header]
+    for day, meals in schedule.items():
+        if day == "جمعه" and not any(meals.get(m) for m in ["صبحانه", "ناهار", "شام"]):
+            parts.append(f"📅 {day} ({meals.get('تاریخ', '')}):\n    معمولاً سرویس غذا وجود ندارد.\n\n")
+            continue
+        parts.append(f"📅 {day} ({meals.get('تاریخ', '')}):\n{format_meals(meals)}\n\n")
+    return "".join(parts)
+
+
+def get_menu_reply(university, schedule, is_today):
+    """Rendered today/week reply from REPLY_CACHE, rebuilt when the menu version changes."""
+    if is_today:
+        today_name = get_today_name()
+        key = (university, "today", today_name)
+    else:
+        today_name = None
+        key = (university, "week")
+
+    menu_version = get_menu_version(university)
+    cached = REPLY_CACHE.get(key)
+    if cached and cached[0] == menu_version:
+        REPLY_CACHE_STATS["hits"] += 1
+        REPLY_CACHE_LOOKUPS.labels("hit").inc()
+        return cached[1]
+
+    REPLY_CACHE_STATS["misses"] += 1
+    REPLY_CACHE_LOOKUPS.labels("miss").inc()
+    if is_today:
+        response = render_today_reply(university, schedule, today_name)
+    else:
+        response = render_week_reply(university, schedule)
+
+    # پاک کردن پاسخ‌های منوی قبلی همین دانشگاه
+    for stale_key in [k for k, v in REPLY_CACHE.items() if k[0] == university and v[0] != menu_version]:
+        del REPLY_CACHE[stale_key]
+    REPLY_CACHE[key] = (menu_version, response)
+    return response
+
+
+def get_reply_cache_stats():
+    hits = REPLY_CACHE_STATS["hits"]
+    misses = REPLY_CACHE_STATS["misses"]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "entries": len(REPLY_CACHE),
+        "hit_rate": hits / total if total else 0.0
+    }
 
 async def handle_food_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    started = time.perf_counter()
     chat_id = update.effective_chat.id
 
     if not is_valid_food_request(update.message.text):
@@ -392,7 +1061,13 @@ async def handle_food_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_allowed, reason = check_rate_limit(chat_id)
 
         if not is_allowed:
-            if reason == "processing":
+            if reason == "busy":
+                await update.message.reply_text(
+                    "⏳ ربات در حال حاضر شلوغ است. لطفاً چند لحظه دیگر دوباره تلاش کنید.",
+                    reply_markup=MAIN_MARKUP
+                )
+                return
+            elif reason == "processing":
                 await update.message.reply_text(
                     "⏳ درخواست قبلی شما در حال پردازش است. لطفاً صبر کنید...",
                     reply_markup=MAIN_MARKUP
@@ -407,70 +1082,45 @@ async def handle_food_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
         # شروع پردازش
-        add_user_to_processing(chat_id)
-        update_user_request_time(chat_id)
-
         try:
             await process_food_query_internal(update, context)
         finally:
-            remove_user_from_processing(chat_id)
+            release_rate_limit(chat_id)
 
     except Exception as e:
         logging.error(f"خطا در handle_food_query: {e}", exc_info=True)
-        remove_user_from_processing(chat_id)
         await update.message.reply_text(
             "خطایی رخ داد. لطفاً دوباره تلاش کنید.",
             reply_markup=MAIN_MARKUP
         )
     finally:
-        remove_user_from_processing(chat_id)
+        HANDLER_LATENCY.labels("handle_food_query").observe(time.perf_counter() - started)
 
 
 async def process_food_query_internal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    started = time.perf_counter()
     try:
         chat_id = update.effective_chat.id
         message_text = update.message.text.lower()
         is_today = "امروز" in message_text or "today" in message_text
 
-        university_result = execute_query(
-            "SELECT university FROM users WHERE chat_id = %s",
-            (chat_id,),
-            fetch="one"
-        )
+        university = await get_user_university(chat_id)
 
-        if not university_result:
+        if not university:
             await update.message.reply_text(
                 "ابتدا باید دانشگاه خود را انتخاب کنید. از دستور /start استفاده کنید.",
                 reply_markup=MAIN_MARKUP
             )
             return
 
-        university = university_result[0]
-
-        html_content_single = None
-        html_content_lunch = None
-        html_content_dinner = None
+        if university not in MENU_SOURCES:
+            logging.warning(f"University '{university}' has no defined menu loading logic.")
+            await update.message.reply_text(f"متاسفانه هنوز اطلاعات منوی دانشگاه {university} در دسترس نیست.",
+                                            reply_markup=MAIN_MARKUP)
+            return
 
         try:
-            if university == "خوارزمی":
-                with open("./layouts/kharazmi_menu.html", "r", encoding="utf-8") as f:
-                    html_content_single = f.read()
-            elif university == "تهران":
-                with open("./layouts/tehran_menu_lunch.html", "r", encoding="utf-8") as f:
-                    html_content_lunch = f.read()
-                with open("./layouts/tehran_menu_dinner.html", "r", encoding="utf-8") as f:
-                    html_content_dinner = f.read()
-            elif university == "خوارزمی تهران":  
-                with open("./layouts/kharazmi_tehran_lunch.html", "r", encoding="utf-8") as f:
-                    html_content_lunch = f.read()
-                with open("./layouts/kharazmi_tehran_dinner.html", "r", encoding="utf-8") as f:
-                    html_content_dinner = f.read()
-            else:
-                logging.warning(f"University '{university}' has no defined menu loading logic.")
-                await update.message.reply_text(f"متاسفانه هنوز اطلاعات منوی دانشگاه {university} در دسترس نیست.",
-                                                reply_markup=MAIN_MARKUP)
-                return
-
+            schedule = await get_university_schedule(university)
         except FileNotFoundError:
             logging.error(f"فایل منوی دانشگاه '{university}' یافت نشد.")
             await update.message.reply_text(
@@ -484,61 +1134,7 @@ async def process_food_query_internal(update: Update, context: ContextTypes.DEFA
                                             reply_markup=MAIN_MARKUP)
             return
 
-        schedule = {}
-
-        if university == "خوارزمی":
-            if html_content_single:
-                schedule = parse_food_schedule(html_content_single, university)
-            else:
-                logging.warning(f"HTML content for {university} not loaded, cannot parse schedule.")
-        elif university == "تهران" or university == "خوارزمی تهران":
-            if html_content_lunch and html_content_dinner:
-                temp1 = parse_food_schedule(html_content_lunch, university)
-                temp2 = parse_food_schedule(html_content_dinner, university)
-                schedule = merge_weekly_menus(temp1, temp2)
-            else:
-                logging.warning(f"Lunch or dinner HTML content for {university} not loaded, cannot parse schedule.")
-        else:
-            logging.warning(f"No parsing logic defined for loaded content of university: '{university}'")
-
-        if is_today:
-            today_name = get_today_name()
-            if today_name == "جمعه" and not schedule.get(today_name):
-                await update.message.reply_text("📵 امروز (جمعه) غذا سرو نمی‌شود.", reply_markup=MAIN_MARKUP)
-                return
-
-            if university == "تهران" and today_name not in schedule:
-                await update.message.reply_text(f"📵 امروز ({today_name}) در دانشگاه تهران غذا سرو نمی‌شود.",
-                                                reply_markup=MAIN_MARKUP)
-                return
-
-            meals_today = schedule.get(today_name, {})
-
-            response = f"🍽 منوی امروز ({today_name}) دانشگاه {university}:\n\n"
-            if not meals_today or not any(meals_today.get(m) for m in ["صبحانه", "ناهار", "شام"]):
-                response += "⚠️ اطلاعات منو برای امروز موجود نیست یا غذا ارائه نمی‌شود."
-            else:
-                response += format_meals(meals_today)
-        else:  # Weekly menu
-            response = f"🗓 منوی هفته جاری دانشگاه {university}:\n\n"
-            if not schedule:
-                response += "⚠️ اطلاعات منوی این هفته هنوز در دسترس نیست."
-            else:
-                days_with_food_listed = False
-                for day, meals in schedule.items():
-
-                    if day == "جمعه" and not any(meals.get(m) for m in ["صبحانه", "ناهار", "شام"]):
-                        response += f"📅 {day} ({meals.get('تاریخ', '')}):\n    معمولاً سرویس غذا وجود ندارد.\n\n"
-                        continue
-
-                    formatted_day_meals = format_meals(meals)
-                    response += f"📅 {day} ({meals.get('تاریخ', '')}):\n{formatted_day_meals}\n\n"
-                    if "موجود نیست" not in formatted_day_meals or "ارائه نمی‌شود" not in formatted_day_meals:
-                        days_with_food_listed = True
-
-                if not days_with_food_listed and not schedule:
-                    response = f"🗓 منوی هفته جاری دانشگاه {university}:\n\n⚠️ اطلاعات منوی این هفته هنوز در دسترس نیست."
-
+        response = get_menu_reply(university, schedule, is_today)
         await update.message.reply_text(response, reply_markup=MAIN_MARKUP)
 
     except Exception as e:
@@ -547,31 +1143,23 @@ async def process_food_query_internal(update: Update, context: ContextTypes.DEFA
             "متأسفانه در دریافت اطلاعات غذا مشکلی پیش آمد. لطفا دوباره تلاش کنید.",
             reply_markup=MAIN_MARKUP
         )
+    finally:
+        HANDLER_LATENCY.labels("process_food_query_internal").observe(time.perf_counter() - started)
 
 # ─── Rate Limiting Functions ────────────────────────────────────────
 def check_rate_limit(chat_id):
-    current_time = time.time()
-
-    if chat_id in USER_PROCESSING:
-        return False, "processing"
-
-    last_request_time = USER_LAST_REQUEST.get(chat_id, 0)  # استفاده از get
-    if current_time - last_request_time < REQUEST_COOLDOWN:
-        remaining_time = REQUEST_COOLDOWN - (current_time - last_request_time)
-        return False, f"cooldown:{remaining_time:.1f}"
-
-    return True, "allowed"
-
-def update_user_request_time(chat_id):
-    USER_LAST_REQUEST[chat_id] = time.time()
+    """Admits a request of chat_id; every admitted request must be followed by release_rate_limit(chat_id)."""
+    is_allowed, reason = RATE_LIMITER.acquire(chat_id)
+    if is_allowed:
+        REQUESTS_IN_FLIGHT.inc()
+    else:
+        RATE_LIMIT_REJECTIONS.labels(reason.split(":", 1)[0]).inc()
+    return is_allowed, reason
 
-def add_user_to_processing(chat_id):
-    USER_PROCESSING.add(chat_id)
-    logging.info(f"User {chat_id} added to processing. Current processing users: {len(USER_PROCESSING)}")
 
-def remove_user_from_processing(chat_id):
-    USER_PROCESSING.discard(chat_id)
-    logging.info(f"User {chat_id} removed from processing. Current processing users: {len(USER_PROCESSING)}")
+def release_rate_limit(chat_id):
+    RATE_LIMITER.release(chat_id)
+    REQUESTS_IN_FLIGHT.dec()
 
 
 # ─── Filter Commands    ────────────────────────────────────────
@@ -588,6 +1176,13 @@ def is_valid_food_request(text: str) -> bool:
     text = (text or "").strip().lower()
     return any(re.match(p, text) for p in VALID_PATTERNS)
 
+
+def update_priority(update):
+    """Food queries get free update slots before conversation bookkeeping (/start, choosing a university)."""
+    message = getattr(update, "message", None)
+    text = message.text if message else None
+    return 0 if text and ("غذای" in text or "منوی" in text) else 1
+
 # ─── Food Commands    ────────────────────────────────────────
 async def today_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
     update.message.text = "غذای امروز"
@@ -616,171 +1211,379 @@ def setup_logging():
     logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
 
+async def save_failed_reminder(chat_id, university, message):
+    """Buffers a failed reminder; rows are written in bulk by flush_failed_reminders."""
+    FAILED_REMINDER_BUFFER.append({
+        "chat_id": chat_id,
+        "university": university,
+        "message": message,
+        "scheduled_at": utc_now() + retry_backoff(0)
+    })
+    if len(FAILED_REMINDER_BUFFER) >= FAILED_REMINDER_FLUSH_SIZE:
+        await flush_failed_reminders()
+
+
+async def flush_failed_reminders():
+    """Writes all buffered failed reminders with multi-row INSERTs."""
+    global FAILED_REMINDER_BUFFER
+    if not FAILED_REMINDER_BUFFER:
+        return 0
+
+    rows, FAILED_REMINDER_BUFFER = FAILED_REMINDER_BUFFER, []
+    written = 0
+    try:
+        for i in range(0, len(rows), FAILED_REMINDER_FLUSH_SIZE):
+            chunk = rows[i:i + FAILED_REMINDER_FLUSH_SIZE]
+            await execute_query(failed_reminders_table.insert().values(chunk), commit=True)
+            written += len(chunk)
+        logging.info(f"Saved {written} failed reminders to DB.")
+    except Exception as db_err:
+        # نگه داشتن ردیف‌های ذخیره نشده برای flush بعدی
+        FAILED_REMINDER_BUFFER[:0] = rows[written:]
+        logging.error(f"Error saving {len(rows) - written} failed reminders to DB: {db_err}")
+    return written
+
+
+async def failed_reminders_flusher():
+    """Background task: flushes the failed reminder buffer every FAILED_REMINDER_FLUSH_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(FAILED_REMINDER_FLUSH_INTERVAL)
+        await flush_failed_reminders()
+
+
 async def send_reminder_to_individual_user(chat_id, message, university):
-    """Sends a reminder to a single user and handles individual errors."""
-    global bot_app
+    """Sends a reminder to a single user. Errors (including RetryAfter) are raised to the broadcast engine."""
     if not bot_app:
-        logging.error("bot_app not initialized. Cannot send message.")
-        try:
-            execute_query(
-                "INSERT INTO failed_reminders (chat_id, university, message, retry_count) VALUES (%s, %s, %s, %s)",
-                (chat_id, university, message, 0),
-                commit=True
-            )
-            logging.info(
-                f"bot_app not ready. Failed reminder for {chat_id} ({university}) saved to DB for later retry.")
-        except Exception as db_err:
-            logging.error(f"Error saving reminder (due to bot_app not ready) for {chat_id} to DB: {db_err}")
-        return
+        raise RuntimeError("bot_app not initialized. Cannot send message.")
 
-    try:
-        await bot_app.bot.send_message(chat_id=chat_id, text=message)
-        logging.info(f"Sent reminder to: {chat_id} ({university})")
-    except Exception as e:
-        logging.error(f"Failed to send reminder to {chat_id} for {university}: {e}")
-        try:
-            execute_query(
-                "INSERT INTO failed_reminders (chat_id, university, message) VALUES (%s, %s, %s)",
-                (chat_id, university, message),
-                commit=True
-            )
-            logging.info(f"Failed reminder for {chat_id} ({university}) saved to DB.")
-        except Exception as db_err:
-            logging.error(f"Error saving failed reminder for {chat_id} to DB: {db_err}")
+    await bot_app.bot.send_message(chat_id=chat_id, text=message)
+    logging.debug(f"Sent reminder to: {chat_id} ({university})")
+
+
+async def iter_university_recipients(university_name, after_chat_id=None, page_size=None, shard=None, shards=1):
+    """Streams the chat_ids of a university (or of one shard, |chat_id| % shards) in keyset pages."""
+    page_size = page_size or BROADCAST_PAGE_SIZE
+    conditions = "university = :university"
+    params = {"university": university_name, "limit": page_size}
+    if shard is not None:
+        conditions += " AND ABS(chat_id) % :shards = :shard"
+        params.update(shards=shards, shard=shard)
+
+    last_chat_id = after_chat_id
+    while True:
+        if last_chat_id is None:
+            query = f"SELECT chat_id FROM users WHERE {conditions} ORDER BY chat_id LIMIT :limit"
+        else:
+            query = f"SELECT chat_id FROM users WHERE {conditions} AND chat_id > :after ORDER BY chat_id LIMIT :limit"
+            params["after"] = last_chat_id
+        rows = await execute_query(query, params, fetch="all") or []
+
+        for row in rows:
+            yield row[0]
+
+        if len(rows) < page_size:
+            return
+        last_chat_id = rows[-1][0]
+
+
+def get_broadcast_cursor(university_name, shard=None):
+    """Last chat_id up to which the current/last broadcast of a university (shard) has been handled."""
+    cursor = BROADCAST_CURSORS.get((university_name, shard))
+    return cursor.position if cursor else None
+
+
+def get_broadcast_limiter():
+    """One limiter for all broadcasts (reminder slots and retries), so together they stay within Telegram's limits."""
+    global broadcast_limiter
+    if broadcast_limiter is None:
+        broadcast_limiter = BroadcastLimiter(BROADCAST_GLOBAL_RATE, BROADCAST_PER_CHAT_INTERVAL)
+    return broadcast_limiter
 
 
-async def process_reminder_for_university(university_name):
-    """Fetches users for a university and sends reminders in batches."""
+async def process_reminder_for_university(university_name, resume_after=None, shard=None, shards=1):
+    """Broadcasts the reminder to a university (or one shard); `resume_after` continues an interrupted run."""
     if university_name not in UNIVERSITY_CONFIG:
         logging.error(f"University configuration not found for: {university_name}")
         return
 
     config = UNIVERSITY_CONFIG[university_name]
     reminder_message = config['reminder_message']
-    logging.info(f"Starting batched reminder process for {university_name}...")
-
-    users_to_remind = []
+    broadcast_name = f"reminder broadcast for {university_name}"
+    if shard is not None:
+        broadcast_name += f" (shard {shard + 1}/{shards})"
+    logging.info(f"Starting {broadcast_name} (after chat_id {resume_after})...")
+
+    sent_counter = BROADCAST_SENT.labels(university_name)
+    failed_counter = BROADCAST_FAILED.labels(university_name)
+    in_progress = BROADCAST_IN_PROGRESS.labels(university_name)
+
+    async def send(chat_id):
+        await send_reminder_to_individual_user(chat_id, reminder_message, university_name)
+        sent_counter.inc()
+
+    async def on_failure(chat_id, error):
+        failed_counter.inc()
+        await save_failed_reminder(chat_id, university_name, reminder_message)
+
+    cursor = BroadcastCursor(resume_after)
+    BROADCAST_CURSORS[(university_name, shard)] = cursor
+    # shards of a university overlap when one takes longer than the slot spacing
+    in_progress.inc()
     try:
-        user_records = execute_query(
-            "SELECT chat_id FROM users WHERE university = %s",
-            (university_name,),
-            fetch="all"
+        stats = await run_broadcast(
+            iter_university_recipients(university_name, after_chat_id=resume_after, shard=shard, shards=shards),
+            send,
+            on_failure=on_failure,
+            limiter=get_broadcast_limiter(),
+            concurrency=BROADCAST_CONCURRENCY,
+            name=broadcast_name,
+            cursor=cursor
         )
-        if user_records:
-            users_to_remind = [record[0] for record in user_records]
     except Exception as e:
-        logging.error(f"Error fetching users for {university_name}: {e}")
-        return
-
-    if not users_to_remind:
-        logging.info(f"No users found for {university_name} to send reminders.")
+        logging.error(f"{broadcast_name} stopped at chat_id {cursor.position}: {e}")
         return
+    finally:
+        in_progress.dec()
+        await flush_failed_reminders()
 
-    logging.info(f"Found {len(users_to_remind)} users for {university_name}. Processing in batches of {BATCH_SIZE}.")
+    BROADCAST_THROUGHPUT.labels(university_name).set(stats["throughput"])
+    BROADCAST_DURATION.labels(university_name).set(stats["elapsed"])
+    if not stats["sent"] and not stats["failed"]:
+        logging.info(f"No users found for {broadcast_name}.")
+    return stats
 
-    for i in range(0, len(users_to_remind), BATCH_SIZE):
-        batch_chat_ids = users_to_remind[i:i + BATCH_SIZE]
-        logging.info(f"Processing batch {i // BATCH_SIZE + 1} for {university_name} with {len(batch_chat_ids)} users.")
 
-        for chat_id in batch_chat_ids:
-            await send_reminder_to_individual_user(chat_id, reminder_message, university_name)
-            await asyncio.sleep(DELAY_BETWEEN_MESSAGES)
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
 
-        if i + BATCH_SIZE < len(users_to_remind):
-            logging.info(f"Waiting {DELAY_BETWEEN_BATCHES}s before next batch for {university_name}.")
-            await asyncio.sleep(DELAY_BETWEEN_BATCHES)
 
-    logging.info(f"Finished batched reminder process for {university_name}.")
+def shift_weekly_time(day_of_week, hour, minute, offset_seconds):
+    """day_of_week/hour/minute plus offset_seconds, wrapping into the next day (and week) if needed."""
+    total = (WEEKDAYS.index(day_of_week) * 24 * 60 + hour * 60 + minute) * 60 + offset_seconds
+    day, rest = divmod(total % (7 * 24 * 3600), 24 * 3600)
+    return {"day_of_week": WEEKDAYS[day], "hour": rest // 3600, "minute": rest % 3600 // 60, "second": rest % 60}
 
 
-def schedule_university_reminders():
-    """Schedules one job per university to send batched reminders."""
+def plan_reminder_slots():
+    """Start time of every (university, shard) reminder slot, staggered over REMINDER_WINDOW_MINUTES."""
+    groups = defaultdict(list)
+    for university_name, config in UNIVERSITY_CONFIG.items():
+        groups[(config['day_of_week'], config['hour'], config['minute'])].append(university_name)
+
+    plan = []
+    for (day_of_week, hour, minute), universities in groups.items():
+        spacing = REMINDER_WINDOW_MINUTES * 60 / (REMINDER_SLOTS * len(universities))
+        for index, university_name in enumerate(universities):
+            for shard in range(REMINDER_SLOTS):
+                # shard k of the i-th of n universities with the same time: no two shards start together
+                offset = int((shard * len(universities) + index) * spacing)
+                plan.append({
+                    "university": university_name,
+                    "shard": shard,
+                    "shards": REMINDER_SLOTS,
+                    "offset": offset,
+                    "spacing": spacing,
+                    **shift_weekly_time(day_of_week, hour, minute, offset)
+                })
+    return plan
+
+
+async def count_reminder_recipients(shards):
+    """Number of users per (university, shard)."""
+    rows = await execute_query(
+        "SELECT university, ABS(chat_id) % :shards AS shard, COUNT(*) FROM users GROUP BY university, shard",
+        {"shards": shards},
+        fetch="all"
+    ) or []
+    return {(university, int(shard)): count for university, shard, count in rows}
+
+
+async def schedule_university_reminders():
+    """Schedules one job per reminder slot (see plan_reminder_slots) and logs when each should finish."""
     global scheduler
     if not scheduler:
         logging.error("Scheduler not initialized. Cannot schedule university reminders.")
         return
 
-    for university_name, config in UNIVERSITY_CONFIG.items():
-        job_id = f"batched_reminder_{university_name}"
+    plan = plan_reminder_slots()
+    try:
+        recipients = await count_reminder_recipients(REMINDER_SLOTS)
+    except Exception as e:
+        logging.error(f"Failed to count reminder recipients, expected completion times are unknown: {e}")
+        recipients = None
+
+    job_ids = set()
+    for slot in plan:
+        university_name, shard = slot["university"], slot["shard"]
+        job_id = f"batched_reminder_{university_name}_{shard}"
         try:
             scheduler.add_job(
                 process_reminder_for_university,
                 'cron',
-                day_of_week=config['day_of_week'],
-                hour=config['hour'],
-                minute=config['minute'],
+                day_of_week=slot['day_of_week'],
+                hour=slot['hour'],
+                minute=slot['minute'],
+                second=slot['second'],
+                jitter=REMINDER_JITTER_SECONDS,
                 id=job_id,
-                kwargs={'university_name': university_name},
+                kwargs={'university_name': university_name, 'shard': shard, 'shards': slot['shards']},
                 replace_existing=True
             )
-            logging.info(
-                f"Scheduled/Updated batched reminders for {university_name} (Job ID: {job_id}) at {config['day_of_week']} {config['hour']}:{config['minute']:02d}")
+            job_ids.add(job_id)
         except Exception as e:
-            logging.error(f"Failed to schedule job for {university_name}: {e}")
+            logging.error(f"Failed to schedule job {job_id}: {e}")
+            continue
+
+        starts_at = f"{slot['day_of_week']} {slot['hour']}:{slot['minute']:02d}:{slot['second']:02d}"
+        if recipients is None:
+            logging.info(f"Scheduled reminders for {university_name} shard {shard + 1}/{slot['shards']} "
+                         f"(Job ID: {job_id}) at {starts_at}")
+            continue
+
+        slot["users"] = recipients.get((university_name, shard), 0)
+        slot["expected_seconds"] = slot["users"] / BROADCAST_GLOBAL_RATE
+        finishes_at = shift_weekly_time(slot['day_of_week'], slot['hour'], slot['minute'],
+                                        slot['second'] + REMINDER_JITTER_SECONDS + int(slot["expected_seconds"]))
+        REMINDER_EXPECTED_DURATION.labels(university_name, str(shard)).set(slot["expected_seconds"])
+        logging.info(
+            f"Scheduled reminders for {university_name} shard {shard + 1}/{slot['shards']} (Job ID: {job_id}) "
+            f"at {starts_at} (±{REMINDER_JITTER_SECONDS}s): {slot['users']} users, expected to finish by "
+            f"{finishes_at['hour']}:{finishes_at['minute']:02d}:{finishes_at['second']:02d}")
+        if slot["expected_seconds"] > slot["spacing"]:
+            logging.warning(
+                f"Reminder slot {job_id} needs ~{slot['expected_seconds']:.0f}s but the next slot starts "
+                f"{slot['spacing']:.0f}s later; they will share the broadcast rate. "
+                f"Consider a longer REMINDER_WINDOW_MINUTES.")
+
+    # jobs of an older layout (e.g. one job per university) are still in the job store
+    for job in scheduler.get_jobs():
+        if job.id.startswith("batched_reminder_") and job.id not in job_ids:
+            scheduler.remove_job(job.id)
+            logging.info(f"Removed outdated reminder job {job.id}")
 
+    REMINDER_PLAN[:] = plan
 
-async def job_listener(event):
+
+def job_listener(event):
     """گوش دادن به رویدادهای job scheduler"""
+    SCHEDULER_JOBS.labels(event.job_id, "error" if event.exception else "success").inc()
     if event.exception:
         logging.error(f"Job ID : {event.job_id} error occured {event.exception}")
     else:
         logging.info(f"Job ID: {event.job_id} done successfully")
 
 
+def utc_now():
+    """Naive UTC datetime; failed_reminders times are always written from Python in UTC."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def retry_backoff(retry_count):
+    return timedelta(seconds=RETRY_BACKOFF_BASE * (2 ** retry_count))
+
+
+async def claim_due_reminders(limit):
+    """Selects up to `limit` due failed reminders and leases them (scheduled_at moved forward) to this run."""
+    now = utc_now()
+    rows = await execute_query(
+        "SELECT id, chat_id, university, message, retry_count FROM failed_reminders "
+        "WHERE retry_count < :max_retries AND scheduled_at <= :now "
+        "ORDER BY scheduled_at LIMIT :limit",
+        {"max_retries": MAX_RETRIES, "now": now, "limit": limit},
+        fetch="all"
+    ) or []
+
+    if rows:
+        await execute_query(
+            text("UPDATE failed_reminders SET scheduled_at = :lease WHERE id IN :ids").bindparams(
+                bindparam("ids", expanding=True)),
+            {"lease": now + timedelta(seconds=RETRY_CLAIM_LEASE), "ids": [row[0] for row in rows]},
+            commit=True
+        )
+    return rows
+
+
+async def park_exhausted_reminders():
+    """Moves reminders that used up MAX_RETRIES (before scheduled_at was cleared for them) out of the due range."""
+    await execute_query(
+        "UPDATE failed_reminders SET scheduled_at = NULL WHERE scheduled_at IS NOT NULL AND retry_count >= :max_retries",
+        {"max_retries": MAX_RETRIES},
+        commit=True
+    )
+
+
+async def resolve_retried_reminders(succeeded_ids, failed_rows):
+    """Deletes delivered reminders and reschedules the failed ones with backoff, in batches."""
+    failed_by_count = defaultdict(list)
+    for reminder_id, chat_id, university, message, retry_count in failed_rows:
+        failed_by_count[retry_count + 1].append(reminder_id)
+
+    if succeeded_ids:
+        await execute_query(
+            text("DELETE FROM failed_reminders WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": succeeded_ids},
+            commit=True
+        )
+
+    now = utc_now()
+    for new_retry_count, reminder_ids in failed_by_count.items():
+        # exhausted reminders are kept as a record, with no scheduled_at so they are never claimed again
+        scheduled_at = now + retry_backoff(new_retry_count) if new_retry_count < MAX_RETRIES else None
+        await execute_query(
+            text("UPDATE failed_reminders SET retry_count = :retry_count, scheduled_at = :scheduled_at "
+                 "WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"retry_count": new_retry_count, "scheduled_at": scheduled_at, "ids": reminder_ids},
+            commit=True
+        )
+        if scheduled_at is None:
+            logging.error(f"Max retries reached for {len(reminder_ids)} reminders. Will not attempt again.")
+
+
 async def retry_failed_reminders():
-    """Retries sending failed reminders in batches."""
+    """Retries due failed reminders, claimed page by page from the (scheduled_at, retry_count) index."""
     global bot_app
     if not bot_app:
         logging.warning("bot_app not ready, skipping retry_failed_reminders for now.")
         return
 
     try:
-        failed_reminders_data = execute_query(
-            "SELECT id, chat_id, university, message, retry_count FROM failed_reminders WHERE retry_count < %s ORDER BY created_at",
-            (MAX_RETRIES,),
-            fetch="all"
-        )
-
-        if not failed_reminders_data:
-            logging.debug("No failed reminders to retry.")
-            return
-
-        logging.info(
-            f"Retrying {len(failed_reminders_data)} failed reminders in batches of {RETRY_BATCH_SIZE}...")  # RETRY_BATCH_SIZE defined globally
+        limiter = get_broadcast_limiter()
+        total_sent = total_failed = 0
+
+        while True:
+            rows = await claim_due_reminders(RETRY_PAGE_SIZE)
+            if not rows:
+                break
+
+            succeeded_ids = []
+            failed_rows = []
+
+            async def send(row):
+                await bot_app.bot.send_message(chat_id=row[1], text=row[3])
+                succeeded_ids.append(row[0])
+
+            async def on_failure(row, error):
+                failed_rows.append(row)
+
+            await run_broadcast(
+                rows,
+                send,
+                on_failure=on_failure,
+                limiter=limiter,
+                concurrency=BROADCAST_CONCURRENCY,
+                name="failed reminders retry",
+                key=lambda row: row[1]
+            )
+            await resolve_retried_reminders(succeeded_ids, failed_rows)
+            total_sent += len(succeeded_ids)
+            total_failed += len(failed_rows)
 
-        for i in range(0, len(failed_reminders_data), RETRY_BATCH_SIZE):
-            batch = failed_reminders_data[i:i + RETRY_BATCH_SIZE]
-            logging.info(f"Processing retry batch {i // RETRY_BATCH_SIZE + 1} with {len(batch)} reminders.")
+            if len(rows) < RETRY_PAGE_SIZE:
+                break
 
-            for reminder_item in batch:
-                reminder_id, chat_id, university, message, retry_count = reminder_item
-                try:
-                    await bot_app.bot.send_message(chat_id=chat_id, text=message)
-                    logging.info(f"Successfully retried reminder ID {reminder_id} for user {chat_id} ({university}).")
-                    execute_query(
-                        "DELETE FROM failed_reminders WHERE id = %s",
-                        (reminder_id,),
-                        commit=True
-                    )
-                except Exception as e:
-                    new_retry_count = retry_count + 1
-                    logging.warning(
-                        f"Retry {new_retry_count}/{MAX_RETRIES} failed for reminder ID {reminder_id} to user {chat_id}: {e}")
-                    execute_query(
-                        "UPDATE failed_reminders SET retry_count = %s WHERE id = %s",
-                        (new_retry_count, reminder_id),
-                        commit=True
-                    )
-                    if new_retry_count >= MAX_RETRIES:
-                        logging.error(f"Max retries reached for reminder ID {reminder_id}. Will not attempt again.")
-
-                await asyncio.sleep(RETRY_DELAY_BETWEEN_MESSAGES)
-
-            if i + RETRY_BATCH_SIZE < len(failed_reminders_data):
-                logging.info(f"Waiting {RETRY_DELAY_BETWEEN_BATCHES}s before next retry batch.")
-                await asyncio.sleep(RETRY_DELAY_BETWEEN_BATCHES)
-
-        logging.info("Finished processing failed reminders.")
+        if total_sent or total_failed:
+            logging.info(f"Finished retrying failed reminders: {total_sent} sent, {total_failed} rescheduled.")
+        else:
+            logging.debug("No failed reminders due for retry.")
 
     except Exception as e:
         logging.error(f"Error in retry_failed_reminders process: {e}", exc_info=True)
@@ -805,11 +1608,7 @@ async def choose_university(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return CHOOSING
     try:
-        execute_query(
-            "INSERT INTO users (chat_id, university) VALUES (%s, %s) ON DUPLICATE KEY UPDATE university = %s",
-            (chat_id, uni, uni),
-            commit=True
-        )
+        await set_user_university(chat_id, uni)
         logging.info(f"User {chat_id} selected/updated university to {uni}.")
 
         await update.message.reply_text(
@@ -829,6 +1628,23 @@ async def on_startup(application):
     global bot_app
     bot_app = application
 
+    if not await init_db():
+        raise RuntimeError("failed to connect to database")
+
+    if not await create_required_tables():
+        raise RuntimeError("failed to create requried tables")
+
+    try:
+        await load_user_directory()
+    except Exception as e:
+        logging.error(f"Failed to load user directory, falling back to lazy loading: {e}")
+
+    global failed_reminders_flush_task, db_supervisor_task
+    failed_reminders_flush_task = asyncio.create_task(failed_reminders_flusher())
+    db_supervisor_task = asyncio.create_task(db_pool_supervisor())
+
+    await start_metrics()
+
     if not scheduler.running:
         scheduler.add_listener(job_listener, EVENT_JOB_ERROR | EVENT_JOB_EXECUTED)
         try:
@@ -838,7 +1654,7 @@ async def on_startup(application):
             logging.error(f"Failed to start scheduler: {e}", exc_info=True)
             return
 
-    schedule_university_reminders()
+    await schedule_university_reminders()
 
     try:
         jobs = scheduler.get_jobs()
@@ -857,17 +1673,14 @@ async def on_startup(application):
         logging.error(f"Error retrieving scheduled jobs: {e}")
 
     try:
-        if not scheduler.get_job("retry_failed_reminders_job"):
-            scheduler.add_job(
-                retry_failed_reminders,
-                'interval',
-                minutes=15,
-                id="retry_failed_reminders_job",
-                replace_existing=True
-            )
-            logging.info("Scheduled periodic job for retrying failed reminders.")
-        else:
-            logging.info("Periodic job for retrying failed reminders already scheduled.")
+        scheduler.add_job(
+            retry_failed_reminders,
+            'interval',
+            minutes=RETRY_POLL_INTERVAL_MINUTES,
+            id="retry_failed_reminders_job",
+            replace_existing=True
+        )
+        logging.info("Scheduled periodic job for retrying failed reminders.")
     except Exception as e:
         logging.error(f"Failed to schedule periodic retry job: {e}")
 
@@ -880,10 +1693,15 @@ async def shutdown(application):
         scheduler.shutdown()
         logging.info("SCHEDULING STOPPED")
 
-    global db_pool
-    if db_pool:
-        logging.info("CLOSED POOL OF DB")
-        db_pool = None
+    shutdown_menu_executor()
+
+    if failed_reminders_flush_task:
+        failed_reminders_flush_task.cancel()
+    if db_supervisor_task:
+        db_supervisor_task.cancel()
+    await flush_failed_reminders()
+    await stop_metrics()
+    await close_db()
 
 
 # ─── Telegram Handlers  ───────────────────────────────────────────────
@@ -908,55 +1726,98 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         raise
 
 
+def build_application(token=None, persistence=None, base_url=None, concurrent_updates=None):
+    """Builds the Application with all handlers; `base_url` points it at another Bot API server (load tests)."""
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("start", start),
+            MessageHandler(filters.Regex(r'^(تغییر دانشگاه|انتخاب دانشگاه)$'), start)
+        ],
+        states={
+            CHOOSING: [
+                MessageHandler(filters.Regex(r'^(خوارزمی|تهران|خوارزمی تهران)$'), choose_university)
+                # Updated Regex
+            ],
+        },
+        fallbacks=[
+            CommandHandler("cancel", lambda u, c: ConversationHandler.END)
+        ],
+        name="university_choice",
+        persistent=persistence is not None
+    )
+
+    concurrent_updates = concurrent_updates or CONCURRENT_UPDATES
+    update_queue = BoundedUpdateQueue(UPDATE_QUEUE_SIZE, MAX_PENDING_UPDATES)
+    builder = Application.builder().token(token or BOT_TOKEN).update_queue(update_queue)
+    if concurrent_updates > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(
+            concurrent_updates,
+            priority=update_priority,
+            max_pending_updates=MAX_PENDING_UPDATES
+        ))
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    application.add_handler(conv_handler)
+
+    application.add_handler(MessageHandler(filters.Regex(".*غذای امروز.*"), handle_food_query))
+    application.add_handler(MessageHandler(filters.Regex(".*غذای این هفته.*"), handle_food_query))
+
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_food_query))
+    return application
+
+
+def check_webhook_settings():
+    # without WEBHOOK_URL, PTB would register https://<listen>:<port>/<path> (e.g. 0.0.0.0) with Telegram
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL, the public https URL of the webhook")
+    if not WEBHOOK_SECRET_TOKEN:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_SECRET_TOKEN, otherwise anyone can post updates")
+
+
+def run_application(application):
+    if BOT_MODE == "webhook":
+        logging.info(f"MACHINE RUNNING (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        logging.info("MACHINE RUNNING (polling)")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+
 # ───  MACHINE RUNNING CONFIGS AND FUNCS HAHAHAHA:)))───────────────────────────────────
 if __name__ == "__main__":
     setup_logging()
 
-    try:
-        if not init_db_pool():
-            logging.critical("failed to connect to database")
-            sys.exit(1)
-
-        if not create_required_tables():
-            logging.critical("failed to create requried tables")
+    if BOT_MODE == "webhook":
+        try:
+            check_webhook_settings()
+        except RuntimeError as e:
+            logging.critical(f"FAILED TO START MACHINE: {e}")
             sys.exit(1)
 
-        persistence = PicklePersistence(filepath="conversation_states")
-
-        conv_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler("start", start),
-                MessageHandler(filters.Regex(r'^(تغییر دانشگاه|انتخاب دانشگاه)$'), start)
-            ],
-            states={
-                CHOOSING: [
-                    MessageHandler(filters.Regex(r'^(خوارزمی|تهران|خوارزمی تهران)$'), choose_university)
-                    # Updated Regex
-                ],
-            },
-            fallbacks=[
-                CommandHandler("cancel", lambda u, c: ConversationHandler.END)
-            ],
-            name="university_choice",
-            persistent=True
-        )
-        application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
-        application.add_handler(conv_handler)
-
-        application.add_handler(MessageHandler(filters.Regex(".*غذای امروز.*"), handle_food_query))
-        application.add_handler(MessageHandler(filters.Regex(".*غذای این هفته.*"), handle_food_query))
+    try:
+        persistence = DatabasePersistence()
 
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_food_query))
+        application = build_application(persistence=persistence)
 
         bot_app = application
 
         application.post_init = on_startup
         application.post_shutdown = shutdown
 
-        logging.info("MACHINE RUNNING")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        run_application(application)
 
-    except mysql.connector.Error as db_error:
+    except SQLAlchemyError as db_error:
         logging.critical(f"DATABASE ERROR ON START: {db_error}")
         asyncio.run(shutdown())
         sys.exit(1)
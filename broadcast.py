@@ -0,0 +1,198 @@
+"""
+Concurrent broadcast engine used for the weekly reminders.
+
+Messages are sent by a pool of workers and paced by a token bucket tuned
+to Telegram's limits (about 30 msg/s for the whole bot and 1 msg/s per
+chat). A RetryAfter from Telegram pauses the shared bucket for exactly
+the requested time instead of sleeping a fixed delay.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+# Telegram allows ~30 messages/second in total; stay a little below it
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_PER_CHAT_INTERVAL = 1.0
+
+
+def retry_after_seconds(error):
+    retry_after = getattr(error, "retry_after", 1)
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """Async token bucket; waiters are served in FIFO order."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stops handing out tokens for `seconds` (used for RetryAfter)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.updated_at = self.paused_until
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BroadcastLimiter:
+    """
+    Global token bucket plus a minimum interval between messages to the
+    same chat. One limiter can be shared by broadcasts running at the same
+    time; per-chat entries are dropped once their interval has passed.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, per_chat_interval=TELEGRAM_PER_CHAT_INTERVAL):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self.chat_next_allowed = OrderedDict()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    def _prune(self, now):
+        chat_next_allowed = self.chat_next_allowed
+        while chat_next_allowed:
+            chat_id = next(iter(chat_next_allowed))
+            if chat_next_allowed[chat_id] > now:
+                return
+            del chat_next_allowed[chat_id]
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        self._prune(now)
+        next_allowed = self.chat_next_allowed.pop(chat_id, 0.0)
+        self.chat_next_allowed[chat_id] = max(now, next_allowed) + self.per_chat_interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+        await self.bucket.acquire()
+
+
+class BroadcastCursor:
+    """
+    Resumable position of a broadcast over ascending chat_ids: every
+    chat_id <= position has been handled (sent or recorded as failed),
+    even though workers finish out of order.
+    """
+
+    def __init__(self, position=None):
+        self.position = position
+        self._pending = deque()
+        self._entries = {}
+
+    def dispatch(self, chat_id):
+        entry = [chat_id, False]
+        self._pending.append(entry)
+        self._entries[chat_id] = entry
+
+    def complete(self, chat_id):
+        entry = self._entries.pop(chat_id, None)
+        if entry:
+            entry[1] = True
+        while self._pending and self._pending[0][1]:
+            self.position = self._pending.popleft()[0]
+
+
+async def run_broadcast(recipients, send, on_failure=None, limiter=None, concurrency=20,
+                        max_attempts=3, name="broadcast", key=None, cursor=None):
+    """
+    Sends to every item in `recipients` (a sync or async iterable) by
+    awaiting `send(item)` from `concurrency` workers. Items are chat_ids
+    unless `key(item)` is given to extract the chat_id for rate limiting.
+
+    RetryAfter pauses the limiter and the same item is retried, up to
+    `max_attempts` times; any other exception fails the item right away.
+    Failed items are handed to `on_failure(item, error)`.
+    If a BroadcastCursor is given, it tracks how far the run has got.
+    Returns a dict with sent, failed, retry_after, elapsed and throughput.
+    """
+    limiter = limiter or BroadcastLimiter()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"sent": 0, "failed": 0, "retry_after": 0}
+    started = time.monotonic()
+
+    async def deliver(item):
+        chat_id = key(item) if key else item
+        error = None
+        for attempt in range(1, max_attempts + 1):
+            await limiter.acquire(chat_id)
+            try:
+                await send(item)
+                stats["sent"] += 1
+                return
+            except RetryAfter as e:
+                error = e
+                delay = retry_after_seconds(e)
+                stats["retry_after"] += 1
+                logging.warning(f"{name}: RetryAfter {delay}s for {chat_id} (attempt {attempt}/{max_attempts})")
+                limiter.pause(delay)
+            except Exception as e:
+                error = e
+                break
+
+        stats["failed"] += 1
+        logging.error(f"{name}: failed to send to {chat_id}: {error}")
+        if on_failure:
+            try:
+                await on_failure(item, error)
+            except Exception as e:
+                logging.error(f"{name}: on_failure handler error for {chat_id}: {e}")
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            await deliver(item)
+            if cursor:
+                cursor.complete(key(item) if key else item)
+
+    async def dispatch(item):
+        if cursor:
+            cursor.dispatch(key(item) if key else item)
+        await queue.put(item)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        if hasattr(recipients, "__aiter__"):
+            async for item in recipients:
+                await dispatch(item)
+        else:
+            for item in recipients:
+                await dispatch(item)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    elapsed = time.monotonic() - started
+    stats["elapsed"] = elapsed
+    stats["throughput"] = stats["sent"] / elapsed if elapsed > 0 else 0.0
+    logging.info(
+        f"{name} finished: sent={stats['sent']}, failed={stats['failed']}, "
+        f"retry_after={stats['retry_after']}, elapsed={elapsed:.1f}s, throughput={stats['throughput']:.1f} msg/s")
+    return stats
@@ -0,0 +1,440 @@
+"""
+Menu parsing shared by the bot and the scraper.
+
+The scraper parses the efood reserve pages at scrape time and writes a
+small versioned JSON snapshot per university; the bot loads the snapshot
+and only falls back to parsing the HTML layouts when it is missing.
+Only depends on beautifulsoup4 so it can run in the scraper workflow.
+"""
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+SNAPSHOT_SCHEMA_VERSION = 1
+
+# "fast" (streaming HTMLParser) or "soup" (full BeautifulSoup tree); both give the same schedule
+MENU_PARSER_ENGINE = os.getenv("MENU_PARSER_ENGINE", "fast")
+
+# Snapshot file and the HTML layouts it is built from, per university.
+# Universities with two layouts: the first is lunch and the second dinner.
+MENU_SOURCES = {
+    "خوارزمی": {
+        "snapshot": "layouts/kharazmi_menu.json",
+        "html": ["layouts/kharazmi_menu.html"]
+    },
+    "تهران": {
+        "snapshot": "layouts/tehran_menu.json",
+        "html": ["layouts/tehran_menu_lunch.html", "layouts/tehran_menu_dinner.html"]
+    },
+    "خوارزمی تهران": {
+        "snapshot": "layouts/kharazmi_tehran_menu.json",
+        "html": ["layouts/kharazmi_tehran_lunch.html", "layouts/kharazmi_tehran_dinner.html"]
+    }
+}
+
+
+def clean_food_name(food):
+    return re.sub(r"(،|\(|\[)?\s*(رایگان|\d{2,3}(,\d{3})?)\s*(تومان|ریال)?\)?$", "", food).strip()
+
+
+def parse_food_schedule(html, university=None):
+    try:
+        soup = BeautifulSoup(html, "html.parser")
+        schedule = {}
+
+        day_containers = soup.find_all("div", class_="dayContainer")
+
+        for day_container in day_containers:
+            day_span = day_container.find(class_="day")
+            date_span = day_container.find(class_="date")
+
+            if day_span:
+                day_name = day_span.get_text(strip=True)
+                date = date_span.get_text(strip=True) if date_span else ""
+
+                schedule[day_name] = {
+                    "تاریخ": date,
+                    "صبحانه": [],
+                    "ناهار": [],
+                    "شام": []
+                }
+
+                current_element = day_container
+
+                while True:
+                    current_element = current_element.find_next_sibling()
+                    if not current_element or (
+                            current_element.get('class') and 'dayContainer' in current_element.get('class')):
+                        break
+
+                    time_meal = current_element.find("span", class_="TimeMeal")
+                    current_meal_type = None
+
+                    if time_meal:
+                        meal_text = time_meal.get_text(strip=True).lower()
+                        if "صبحانه" in meal_text:
+                            current_meal_type = "صبحانه"
+                        elif "ناهار" in meal_text or "نهار" in meal_text:
+                            current_meal_type = "ناهار"
+                        elif "شام" in meal_text:
+                            current_meal_type = "شام"
+
+                    if current_meal_type:
+                        meal_divs = current_element.find_all("div", id="MealDiv")
+                        for meal_div in meal_divs:
+                            food_labels = meal_div.find_all("label", class_="reserveFoodCheckBox")
+                            for label in food_labels:
+                                if label.get('for') and label.get_text(strip=True):
+                                    food_text = clean_food_name(label.get_text(strip=True))
+                                    if food_text and food_text not in schedule[day_name][current_meal_type]:
+                                        schedule[day_name][current_meal_type].append(food_text)
+
+        return schedule
+
+    except Exception as e:
+        print(f"خطا در خواندن برنامه غذایی: {e}")
+        return {
+            day: {"تاریخ": "", "صبحانه": [], "ناهار": [], "شام": []}
+            for day in ["شنبه", "یکشنبه", "دوشنبه", "سه شنبه", "چهارشنبه", "پنج شنبه"]
+        }
+
+
+# --- Fast parser ---
+# Elements BeautifulSoup closes immediately (html.parser tree builder)
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta",
+    "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex",
+    "nextid", "spacer"
+}
+# Strings inside these are not returned by BeautifulSoup's get_text()
+NON_TEXT_ELEMENTS = {"script", "style", "template"}
+
+
+def _has_class(attrs, name):
+    classes = attrs.get("class") or ""
+    return name in classes.split() or classes == name
+
+
+def _meal_type(meal_text):
+    meal_text = meal_text.lower()
+    if "صبحانه" in meal_text:
+        return "صبحانه"
+    if "ناهار" in meal_text or "نهار" in meal_text:
+        return "ناهار"
+    if "شام" in meal_text:
+        return "شام"
+    return None
+
+
+class MenuPageParser(HTMLParser):
+    """
+    Single-pass extractor for the efood reserve page that produces the same
+    schedule as parse_food_schedule without building a tree. It keeps a
+    stack of open elements (popped like BeautifulSoup does) and only
+    collects text for the day/date, TimeMeal and reserveFoodCheckBox
+    elements around each dayContainer and its following siblings.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.schedule = {}
+        self._containers = []
+        self._stack = []
+        self._next_id = 0
+        self._day_by_parent = {}
+        self._day_containers = []
+        self._sections = []
+        self._meal_divs = []
+        self._captures = []
+        self._non_text_depth = 0
+
+    # text capture
+    def _capture(self, depth, on_done):
+        self._captures.append({"depth": depth, "parts": [], "on_done": on_done})
+
+    def handle_data(self, data):
+        if self._non_text_depth or not self._captures:
+            return
+        data = data.strip()
+        if data:
+            for capture in self._captures:
+                capture["parts"].append(data)
+
+    # element stack
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: ("" if value is None else value) for name, value in attrs}
+        depth = len(self._stack)
+        parent_id = self._stack[-1]["id"] if self._stack else None
+        self._next_id += 1
+        element = {"id": self._next_id, "tag": tag, "depth": depth}
+
+        is_day_container = tag == "div" and _has_class(attrs, "dayContainer")
+        if parent_id in self._day_by_parent:
+            if is_day_container:
+                self._day_by_parent[parent_id] = None
+            elif self._day_by_parent[parent_id] is not None:
+                element["section"] = {"container": self._day_by_parent[parent_id], "meal": None,
+                                      "meal_found": False, "labels": []}
+                self._sections.append(element)
+
+        for container in self._day_containers:
+            for key in ("day", "date"):
+                if not container[key + "_found"] and _has_class(attrs, key):
+                    container[key + "_found"] = True
+                    self._capture(depth, lambda text, c=container, k=key: c.__setitem__(k, text))
+
+        if tag == "span" and _has_class(attrs, "TimeMeal"):
+            for section_element in self._sections:
+                section = section_element["section"]
+                if not section["meal_found"]:
+                    section["meal_found"] = True
+                    self._capture(depth, lambda text, s=section: s.__setitem__("meal", _meal_type(text)))
+
+        if tag == "label" and _has_class(attrs, "reserveFoodCheckBox"):
+            sections = [e["section"] for e in self._sections
+                        if any(meal_div > e["depth"] for meal_div in self._meal_divs)]
+            if sections:
+                # the slot is reserved now so nested labels keep document (start tag) order
+                slot = [None]
+                for section in sections:
+                    section["labels"].append(slot)
+                has_for = bool(attrs.get("for"))
+                self._capture(depth, lambda text, sl=slot, f=has_for: self._set_label(sl, f, text))
+
+        if is_day_container:
+            element["day_container"] = {"parent": parent_id, "day_found": False, "day": "",
+                                        "date_found": False, "date": "", "meals": None}
+            self._day_containers.append(element["day_container"])
+            self._containers.append(element["day_container"])
+
+        if tag == "div" and attrs.get("id") == "MealDiv":
+            element["meal_div"] = True
+            self._meal_divs.append(depth)
+
+        if tag in VOID_ELEMENTS:
+            return
+        if tag in NON_TEXT_ELEMENTS:
+            self._non_text_depth += 1
+        self._stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i]["tag"] == tag:
+                while len(self._stack) > i:
+                    self._close(self._stack.pop())
+                return
+
+    def close(self):
+        super().close()
+        while self._stack:
+            self._close(self._stack.pop())
+
+        # same assignment order as parse_food_schedule: later days with the same name replace earlier ones
+        for container in self._containers:
+            if container["meals"] is not None:
+                self.schedule[container["day"]] = container["meals"]
+
+    def _close(self, element):
+        depth = element["depth"]
+        if element["tag"] in NON_TEXT_ELEMENTS:
+            self._non_text_depth -= 1
+
+        while self._captures and self._captures[-1]["depth"] >= depth:
+            capture = self._captures.pop()
+            capture["on_done"]("".join(capture["parts"]))
+
+        if element.get("meal_div"):
+            self._meal_divs.pop()
+
+        if "section" in element:
+            self._sections.remove(element)
+            section = element["section"]
+            if section["meal"]:
+                foods = section["container"]["meals"][section["meal"]]
+                for slot in section["labels"]:
+                    food_text = slot[0]
+                    if food_text and food_text not in foods:
+                        foods.append(food_text)
+
+        container = element.get("day_container")
+        if container:
+            self._day_containers.remove(container)
+            if container["day_found"]:
+                container["meals"] = {
+                    "تاریخ": container["date"],
+                    "صبحانه": [],
+                    "ناهار": [],
+                    "شام": []
+                }
+                self._day_by_parent[container["parent"]] = container
+            else:
+                self._day_by_parent[container["parent"]] = None
+
+        self._day_by_parent.pop(element["id"], None)
+
+    def _set_label(self, slot, has_for, text):
+        if has_for and text:
+            slot[0] = clean_food_name(text)
+
+
+def fast_parse_food_schedule(html, university=None):
+    try:
+        parser = MenuPageParser()
+        parser.feed(html)
+        parser.close()
+        return parser.schedule
+
+    except Exception as e:
+        print(f"خطا در خواندن برنامه غذایی: {e}")
+        return {
+            day: {"تاریخ": "", "صبحانه": [], "ناهار": [], "شام": []}
+            for day in ["شنبه", "یکشنبه", "دوشنبه", "سه شنبه", "چهارشنبه", "پنج شنبه"]
+        }
+
+
+MENU_PARSERS = {
+    "soup": parse_food_schedule,
+    "fast": fast_parse_food_schedule
+}
+
+
+def parse_menu_html(html, university=None, engine=None):
+    """Parses a reserve page with the configured engine (MENU_PARSER_ENGINE: "fast" or "soup")."""
+    return MENU_PARSERS[engine or MENU_PARSER_ENGINE](html, university)
+
+
+def merge_weekly_menus(menu1, menu2):
+    merged_menu = {}
+    days_order = ["شنبه", "یکشنبه", "دوشنبه", "سه شنبه", "چهارشنبه", "پنج شنبه", "جمعه"]
+    all_days = set(menu1.keys()) | set(menu2.keys())
+
+    for day in days_order:
+        if day in all_days:
+            merged_menu[day] = {
+                'تاریخ': menu1.get(day, {}).get('تاریخ', '') or menu2.get(day, {}).get('تاریخ', ''),
+                'صبحانه': menu1.get(day, {}).get('صبحانه', []),
+                'ناهار': [],
+                'شام': []
+            }
+
+            lunch_items_from_lunch_file = menu1.get(day, {}).get('ناهار', [])
+            dinner_items_from_dinner_file = menu2.get(day, {}).get('شام', [])
+
+            if day == "پنجشنبه":
+                if dinner_items_from_dinner_file and not lunch_items_from_lunch_file:
+                    merged_menu[day]['ناهار'] = dinner_items_from_dinner_file
+                    merged_menu[day]['شام'] = []
+                else:
+                    merged_menu[day]['ناهار'] = lunch_items_from_lunch_file
+                    merged_menu[day]['شام'] = dinner_items_from_dinner_file
+            else:
+                merged_menu[day]['ناهار'] = lunch_items_from_lunch_file
+                merged_menu[day]['شام'] = dinner_items_from_dinner_file
+    return merged_menu
+
+
+def build_university_schedule(university, contents):
+    """منوی یک فایلی را مستقیم و منوی ناهار/شام را بعد از ادغام برمی‌گرداند."""
+    if len(contents) == 1:
+        return parse_menu_html(contents[0], university)
+
+    lunch_schedule = parse_menu_html(contents[0], university)
+    dinner_schedule = parse_menu_html(contents[1], university)
+    return merge_weekly_menus(lunch_schedule, dinner_schedule)
+
+
+# --- Change detection ---
+def menu_section_hash(html):
+    """
+    Hash of the meaningful menu section of a reserve page: the containers
+    of the dayContainer blocks, without scripts and hidden inputs (the
+    anti-forgery token changes on every request) and with whitespace
+    collapsed. Falls back to the whole page when no day is found.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    sections = []
+    for day_container in soup.find_all("div", class_="dayContainer"):
+        if day_container.parent not in sections:
+            sections.append(day_container.parent)
+    if not sections:
+        sections = [soup]
+
+    parts = []
+    for section in sections:
+        for tag in section.find_all(["script", "style"]):
+            tag.decompose()
+        for tag in section.find_all("input", type="hidden"):
+            tag.decompose()
+        parts.append(" ".join(section.get_text(" ", strip=True).split()))
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+# --- Snapshots ---
+def schedule_hash(schedule):
+    canonical = json.dumps(schedule, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def build_snapshot(university, schedule, sources=()):
+    return {
+        "schema_version": SNAPSHOT_SCHEMA_VERSION,
+        "university": university,
+        "generated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "sources": list(sources),
+        "content_hash": schedule_hash(schedule),
+        "schedule": schedule
+    }
+
+
+def load_snapshot(path):
+    """Returns the snapshot at `path`, or None if it has another schema version."""
+    with open(path, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    if snapshot.get("schema_version") != SNAPSHOT_SCHEMA_VERSION:
+        return None
+    return snapshot
+
+
+def write_snapshot(path, snapshot):
+    """
+    Atomically writes `snapshot` to `path`. Returns False without touching
+    the file when the stored snapshot already has the same content hash.
+    """
+    if os.path.exists(path):
+        try:
+            existing = load_snapshot(path)
+            if existing and existing.get("content_hash") == snapshot["content_hash"]:
+                return False
+        except (OSError, ValueError):
+            pass
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, indent=1)
+        f.write("\n")
+    os.replace(tmp_path, path)
+    return True
+
+
+def build_university_snapshot(university):
+    """Parses the HTML layouts of a university and writes its snapshot; returns True if it changed."""
+    sources = MENU_SOURCES[university]
+    contents = []
+    for path in sources["html"]:
+        with open(path, "r", encoding="utf-8") as f:
+            contents.append(f.read())
+
+    schedule = build_university_schedule(university, contents)
+    snapshot = build_snapshot(university, schedule, sources["html"])
+    return write_snapshot(sources["snapshot"], snapshot)
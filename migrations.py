@@ -0,0 +1,118 @@
+"""
+Versioned schema migrations.
+
+Every migration has a version, a description and an `upgrade(connection)`
+function that runs on a synchronous SQLAlchemy connection (through
+`run_sync`). `apply_migrations` records applied versions in the
+schema_migrations table and runs the missing ones in order, each in its
+own transaction.
+
+Migrations build their own Table/Index objects instead of using the
+models in bot.py, so they keep describing the schema as it was at that
+version, and they create with checkfirst, so databases created before
+migrations existed (by CREATE TABLE IF NOT EXISTS / create_all) are
+upgraded in place. Never change a released migration; add a new one.
+"""
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table, Text, TIMESTAMP, func, select, text
+)
+from sqlalchemy.exc import IntegrityError
+
+migrations_metadata = MetaData()
+
+schema_migrations_table = Table(
+    "schema_migrations", migrations_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False)
+)
+
+
+def create_base_tables(connection):
+    metadata = MetaData()
+    Table(
+        "users", metadata,
+        Column("chat_id", BigInteger, primary_key=True, autoincrement=False),
+        Column("university", String(50), nullable=False),
+        Column("created_at", TIMESTAMP, server_default=func.current_timestamp()),
+        Column("updated_at", TIMESTAMP, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+    )
+    Table(
+        "failed_reminders", metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("chat_id", BigInteger, nullable=False, index=True),
+        Column("university", String(50), nullable=False),
+        Column("message", Text, nullable=False),
+        Column("retry_count", Integer, server_default=text("0")),
+        Column("created_at", TIMESTAMP, server_default=func.current_timestamp()),
+        Column("scheduled_at", TIMESTAMP, server_default=func.current_timestamp())
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+def create_conversation_states(connection):
+    metadata = MetaData()
+    Table(
+        "conversation_states", metadata,
+        Column("name", String(50), primary_key=True),
+        Column("conversation_key", String(100), primary_key=True),
+        Column("state", Integer, nullable=False),
+        Column("updated_at", TIMESTAMP, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+def add_index(table_name, index_name, *column_names):
+    """An upgrade() that creates one index, unless a previous create_all already did."""
+    def upgrade(connection):
+        table = Table(table_name, MetaData(), *(Column(name) for name in column_names))
+        Index(index_name, *(table.c[name] for name in column_names)).create(connection, checkfirst=True)
+    return upgrade
+
+
+# (version, description, upgrade)
+MIGRATIONS = [
+    (1, "users and failed_reminders tables", create_base_tables),
+    (2, "conversation_states table", create_conversation_states),
+    # keyset pages of a university's recipients, shard counts (covering: chat_id is in the index)
+    (3, "index users by university and chat_id",
+     add_index("users", "ix_users_university_chat_id", "university", "chat_id")),
+    # claim_due_reminders: scheduled_at <= now AND retry_count < max ORDER BY scheduled_at
+    (4, "index failed_reminders by due time",
+     add_index("failed_reminders", "ix_failed_reminders_due", "scheduled_at", "retry_count")),
+    # load_user_directory: most recently updated users, read from the index alone
+    (5, "covering index of users by updated_at",
+     add_index("users", "ix_users_updated_at", "updated_at", "chat_id", "university")),
+]
+
+
+def applied_versions(connection):
+    schema_migrations_table.create(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migrations_table.c.version)).scalars())
+
+
+async def apply_migrations(engine):
+    """Runs the migrations not yet recorded in schema_migrations, in order. Returns the applied versions."""
+    async with engine.begin() as conn:
+        done = await conn.run_sync(applied_versions)
+
+    applied = []
+    for version, description, upgrade in sorted(MIGRATIONS, key=lambda migration: migration[0]):
+        if version in done:
+            continue
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(upgrade)
+                await conn.execute(schema_migrations_table.insert().values(
+                    version=version, description=description,
+                    applied_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+        except IntegrityError:
+            # another instance applied it at the same time; upgrades are idempotent
+            logging.info(f"Migration {version} was applied concurrently, skipping.")
+            continue
+        applied.append(version)
+        logging.info(f"Applied migration {version}: {description}")
+    return applied
@@ -0,0 +1,82 @@
+"""
+Per-chat rate limiting for incoming requests.
+
+Every chat gets a token bucket (`rate` tokens per second, up to `burst`)
+and at most one request in flight; the bot as a whole has at most
+`max_in_flight` requests in flight.
+
+A bucket is stored as a single float, the time at which it will be full
+again (GCRA's "theoretical arrival time"), in an OrderedDict kept in
+last-use order. Once that time has passed the bucket is the same as no
+bucket, so such entries are dropped from the front as new requests
+arrive, and `max_chats` caps the store (least recently used first).
+Memory stays bounded however many distinct chats the bot has seen.
+"""
+import time
+from collections import OrderedDict
+
+# entries pruned per acquire; keeps the cost O(1) while the store shrinks steadily
+PRUNE_PER_CALL = 2
+
+
+class ChatRateLimiter:
+    def __init__(self, rate, burst=1, max_chats=100000, max_in_flight=100, clock=time.monotonic):
+        self.interval = 1 / rate
+        self.burst = burst
+        # how far ahead of now a bucket's full-time may be while a token is still left
+        self.tolerance = (burst - 1) * self.interval
+        self.max_chats = max_chats
+        self.max_in_flight = max_in_flight
+        self.clock = clock
+        self.buckets = OrderedDict()  # chat_id -> time at which the bucket is full again
+        self.in_flight = set()
+        self.evictions = 0
+
+    def _prune(self, now):
+        buckets = self.buckets
+        for _ in range(PRUNE_PER_CALL):
+            if not buckets:
+                return
+            chat_id = next(iter(buckets))
+            if buckets[chat_id] > now or chat_id in self.in_flight:
+                return
+            del buckets[chat_id]
+
+    def acquire(self, chat_id):
+        """
+        Takes a token and marks the chat as in flight. Returns (allowed, reason)
+        with reason "allowed", "processing", "busy" (global in-flight cap) or
+        "cooldown:<seconds until the next token>".
+        """
+        if chat_id in self.in_flight:
+            return False, "processing"
+        if len(self.in_flight) >= self.max_in_flight:
+            return False, "busy"
+
+        now = self.clock()
+        self._prune(now)
+
+        full_at = self.buckets.get(chat_id)
+        if full_at is None or full_at < now:
+            full_at = now
+        elif full_at - now > self.tolerance:
+            return False, f"cooldown:{full_at - now - self.tolerance:.1f}"
+
+        if chat_id in self.buckets:
+            self.buckets.move_to_end(chat_id)
+        elif len(self.buckets) >= self.max_chats:
+            self.buckets.popitem(last=False)
+            self.evictions += 1
+        self.buckets[chat_id] = full_at + self.interval
+        self.in_flight.add(chat_id)
+        return True, "allowed"
+
+    def release(self, chat_id):
+        self.in_flight.discard(chat_id)
+
+    def stats(self):
+        return {
+            "chats": len(self.buckets),
+            "in_flight": len(self.in_flight),
+            "evictions": self.evictions
+        }
@@ -1,8 +1,15 @@
 
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 
+from menu_parser import MENU_SOURCES, build_university_snapshot, menu_section_hash
+
 # --- Configuration ---
 # You can add more menus here in the future
 MENU_CONFIGS = [
@@ -27,7 +34,7 @@ MENU_CONFIGS = [
     # }
 ]
 
-BASE_URL = "https://efood.khu.ac.ir"
+BASE_URL = os.getenv("EFOOD_BASE_URL", "https://efood.khu.ac.ir")
 LOGIN_URL = f"{BASE_URL}/Account/Login?ReturnUrl=%2f/"
 MENU_REQUEST_URL = f"{BASE_URL}/Reserves/GetReservePage"
 
@@ -35,20 +42,98 @@ MENU_REQUEST_URL = f"{BASE_URL}/Reserves/GetReservePage"
 USERNAME = os.getenv("UNIVERSITY_USERNAME")
 PASSWORD = os.getenv("UNIVERSITY_PASSWORD")
 
+# --- Fetching ---
+MAX_CONCURRENT_FETCHES = 4
+REQUEST_TIMEOUT = (10, 60)  # (connect, read) seconds
+FETCH_RETRIES = 3
+FETCH_BACKOFF_FACTOR = 1  # sleeps 1s, 2s, 4s between retries
+
+
+def create_session():
+    """
+    Creates a session whose connection pool can serve MAX_CONCURRENT_FETCHES
+    requests at once and that retries failed requests with backoff.
+    """
+    retry = Retry(
+        total=FETCH_RETRIES,
+        backoff_factor=FETCH_BACKOFF_FACTOR,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,  # the menu endpoint is a POST, retry it too
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_FETCHES, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def stored_menu_hash(path):
+    """Menu section hash of the previously saved file, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return menu_section_hash(f.read())
+
+
+def fetch_menu(session, config):
+    """
+    Fetches one configured menu with the logged-in session and saves it,
+    unless its menu section hash equals the one of the saved file.
+    Returns (changed, elapsed seconds).
+    """
+    started = time.monotonic()
+    menu_response = session.post(MENU_REQUEST_URL, data=config['payload'], timeout=REQUEST_TIMEOUT)
+    menu_response.raise_for_status()
+
+    if menu_section_hash(menu_response.text) == stored_menu_hash(config['output_file']):
+        return False, time.monotonic() - started
+
+    # Ensure the directory exists
+    os.makedirs(os.path.dirname(config['output_file']), exist_ok=True)
+    with open(config['output_file'], "w", encoding="utf-8") as f:
+        f.write(menu_response.text)
+    return True, time.monotonic() - started
+
+
+def build_snapshots(changed_files=None):
+    """
+    Parses the saved layouts and writes the JSON menu snapshot of every
+    university that has them. With `changed_files`, only universities with
+    a changed layout (or no snapshot yet) are rebuilt.
+    """
+    for university, sources in MENU_SOURCES.items():
+        if not all(os.path.exists(path) for path in sources["html"]):
+            continue
+        if (changed_files is not None and os.path.exists(sources["snapshot"])
+                and not any(path in changed_files for path in sources["html"])):
+            print(f"Snapshot {sources['snapshot']} unchanged (layouts unchanged)")
+            continue
+        try:
+            changed = build_university_snapshot(university)
+            status = "updated" if changed else "unchanged"
+            print(f"Snapshot {sources['snapshot']} {status}")
+        except Exception as e:
+            print(f"Could not build snapshot for {sources['snapshot']}: {e}")
+
+
 def scrape_menus():
     """
     Logs into the university website using a session, then fetches and saves
-    all configured menu HTML files.
+    all configured menu HTML files concurrently. Returns the set of output
+    files whose menu changed, or None when nothing could be fetched.
     """
     if not USERNAME or not PASSWORD:
         print("Error: UNIVERSITY_USERNAME or UNIVERSITY_PASSWORD secrets are not set in GitHub.")
-        return
+        return None
 
-    with requests.Session() as session:
+    changed_files = set()
+
+    with create_session() as session:
         try:
             # Step 1: Get the login page to extract the CSRF token
             print("Fetching login page to get CSRF token...")
-            login_page_response = session.get(LOGIN_URL)
+            login_page_response = session.get(LOGIN_URL, timeout=REQUEST_TIMEOUT)
             login_page_response.raise_for_status()
 
             soup = BeautifulSoup(login_page_response.text, 'html.parser')
@@ -64,34 +149,48 @@ def scrape_menus():
             }
             
             print("Sending login request...")
-            login_response = session.post(LOGIN_URL, data=login_payload)
+            login_response = session.post(LOGIN_URL, data=login_payload, timeout=REQUEST_TIMEOUT)
             login_response.raise_for_status()
 
             if "نام کاربری یافت نشد" in login_response.text or "کلمه عبور اشتباه است" in login_response.text:
                 print("Error: Login failed. Please check your username and password in GitHub Secrets.")
-                return
+                return None
 
             print("Login successful.")
 
-            # Step 3: Iterate through menu configs and fetch each one
-            for config in MENU_CONFIGS:
-                print("-" * 30)
-                print(f"Fetching: {config['description']}...")
-                
-                menu_response = session.post(MENU_REQUEST_URL, data=config['payload'])
-                menu_response.raise_for_status()
-                
-                # Step 4: Save the HTML content to the specified file
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(config['output_file']), exist_ok=True)
-                with open(config['output_file'], "w", encoding="utf-8") as f:
-                    f.write(menu_response.text)
-                print(f"Menu saved successfully to {config['output_file']}")
+            # Step 3: Fetch and save all menu configs concurrently over the same session
+            started = time.monotonic()
+            workers = max(1, min(MAX_CONCURRENT_FETCHES, len(MENU_CONFIGS)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(fetch_menu, session, config): config for config in MENU_CONFIGS}
+                for future in as_completed(futures):
+                    config = futures[future]
+                    print("-" * 30)
+                    try:
+                        changed, elapsed = future.result()
+                        if changed:
+                            changed_files.add(config['output_file'])
+                            print(f"{config['description']}: changed, saved to {config['output_file']} in {elapsed:.1f}s")
+                        else:
+                            print(f"{config['description']}: unchanged, kept {config['output_file']} ({elapsed:.1f}s)")
+                    except requests.exceptions.RequestException as e:
+                        print(f"{config['description']}: a network error occurred: {e}")
+                    except OSError as e:
+                        print(f"{config['description']}: could not save {config['output_file']}: {e}")
+
+            print(f"Fetched {len(MENU_CONFIGS)} menus in {time.monotonic() - started:.1f}s, "
+                  f"{len(changed_files)} changed")
 
         except requests.exceptions.RequestException as e:
             print(f"A network error occurred: {e}")
+            return None
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
+            return None
+
+    return changed_files
 
 if __name__ == "__main__":
-    scrape_menus()
+    changed_files = scrape_menus()
+    if changed_files is not None:
+        build_snapshots(changed_files)
@@ -0,0 +1,134 @@
+"""
+Concurrent update processing for the Application.
+
+Up to `max_concurrent_updates` updates run at the same time, but updates
+of the same chat still run one after another in arrival order (a per-chat
+lock), so conversation states and rate limiting see them in order. When
+all slots are busy, waiting updates get the next free slot by priority
+(lower first, see `priority`), then in arrival order.
+
+With concurrent updates PTB starts a task for every update it takes from
+the update_queue, so the queue alone never fills. `BoundedUpdateQueue`
+stops handing out updates while `max_pending` of them are being
+processed; the queue then fills and polling/webhook put() waits.
+"""
+import asyncio
+import heapq
+import itertools
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """An update_queue whose get() waits until fewer than `max_pending` updates are being processed."""
+
+    def __init__(self, maxsize, max_pending):
+        super().__init__(maxsize)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.in_process = 0
+
+    async def get(self):
+        await self.pending.acquire()
+        try:
+            update = await super().get()
+        except BaseException:
+            self.pending.release()
+            raise
+        self.in_process += 1
+        return update
+
+    def task_done(self):
+        # the Application calls task_done() once an update has been handled
+        super().task_done()
+        if self.in_process:
+            self.in_process -= 1
+            self.pending.release()
+
+
+class PrioritySlots:
+    """A semaphore whose waiters are woken by (priority, arrival order)."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority):
+        if self.in_use < self.capacity and not self._waiters:
+            self.in_use += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            # the releasing task hands its slot over, so in_use is not changed here
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    `priority(update)` returns a number; lower runs first when slots are
+    scarce. PTB's own semaphore is set to `max_pending_updates` (the
+    BoundedUpdateQueue limit), so updates waiting for a chat lock never
+    hold back other chats.
+    """
+
+    def __init__(self, max_concurrent_updates, priority=None, max_pending_updates=None):
+        super().__init__(max(max_concurrent_updates, max_pending_updates or 0))
+        self.slots = PrioritySlots(max_concurrent_updates)
+        self.priority = priority or (lambda update: 0)
+        self.chat_locks = {}  # chat_id -> [lock, users]
+
+    @staticmethod
+    def chat_id_of(update):
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat else None
+
+    async def run_in_slot(self, update, coroutine):
+        await self.slots.acquire(self.priority(update))
+        try:
+            await coroutine
+        finally:
+            self.slots.release()
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            chat_id = self.chat_id_of(update)
+            if chat_id is None:
+                await self.run_in_slot(update, coroutine)
+                return
+
+            entry = self.chat_locks.get(chat_id)
+            if entry is None:
+                entry = self.chat_locks[chat_id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self.run_in_slot(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.chat_locks[chat_id]
+        except BaseException:
+            # cancelled while waiting: the handler coroutine was never started
+            coroutine.close()
+            raise
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass